@@ -0,0 +1,250 @@
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from glob import glob
+import json
+from math import ceil, log2
+from multiprocessing import get_context
+import os
+import resource
+import sys
+import time
+from typing import Callable
+
+from bitarray import bitarray
+
+from container import open_lab
+
+root = os.path.dirname(os.path.abspath(__file__))
+synthetic = {'1K': 2 ** 10, '1M': 2 ** 20, '10M': 10 * 2 ** 20, '100M': 100 * 2 ** 20}
+max_sizes = (None, 2 ** 10, 2 ** 18)
+
+# region [[Inputs]]
+def synthetic_path(name: str) -> str:
+  return os.path.join(root, 'results', 'benchmark', f'synthetic_{name}.txt')
+
+# Synthetic text is generated by the lab-1 Markov model of Hamlet, so that it
+# looks like the bundled texts to every codec, and is kept between the runs.
+def create_synthetic(name: str) -> str:
+  path = synthetic_path(name)
+  if not os.path.exists(path):
+    lab = open_lab('lab-1')
+    with open(os.path.join(root, 'lab-1', 'resources', 'norm_hamlet.txt')) as file:
+      index = lab.create_ngram_index(file.read(), 4)
+    model = lab.create_markov_model(lab.conditional_weights_from_index(index, 3), 3)
+    chains = min(1024, max(1, synthetic[name] >> 14))
+    text = ' '.join(lab.generate_markov_chains(model, -(-synthetic[name] // chains) + 3, 'the', seed=0, chains=chains))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+      file.write(text[:synthetic[name]])
+  return path
+
+def find_inputs(names: list[str]) -> list[str]:
+  inputs = []
+  for name in names:
+    if name in synthetic:
+      inputs.append(name)
+    elif name == 'resources':
+      inputs.extend(sorted(os.path.relpath(path, root) for path in glob(os.path.join(root, 'lab-*', 'resources', '*.txt'))))
+    else:
+      inputs.append(name)
+  return inputs
+
+def readinput(name: str) -> str:
+  with open(synthetic_path(name) if name in synthetic else os.path.join(root, name)) as file:
+    return file.read()
+# endregion
+
+# region [[Cases]]
+# Every case gets the text and returns the size of its output in bytes (None
+# for the n-gram builders) with seconds spent encoding and decoding.
+def timed(function: Callable, *args):
+  start = time.perf_counter()
+  result = function(*args)
+  return result, time.perf_counter() - start
+
+def frombytes(payload: bytes) -> bitarray:
+  (encoded := bitarray()).frombytes(payload)
+  return encoded
+
+def fixed(text: str, *, array: bool):
+  lab = open_lab('lab-4')
+  def encode(text: str) -> tuple[str, bytes]:
+    code = lab.create(Counter(text))
+    encoded = lab.encode_array(text, code) if array else lab.encode(text, lab.create_encoding(code))
+    return code, encoded.tobytes()
+  def decode(code: str, payload: bytes) -> str:
+    if array: return lab.decode_array(frombytes(payload), code)
+    return lab.decode(frombytes(payload), lab.create_decoding(code))
+
+  ((code, payload), encode_time) = timed(encode, text)
+  (decoded, decode_time) = timed(decode, code, payload)
+  assert decoded == text
+  return len(code.encode()) + len(payload), encode_time, decode_time
+
+def huffman(text: str, *, table: bool):
+  lab = open_lab('lab-5')
+  def encode(text: str) -> tuple[bytes, bytes]:
+    code = lab.create_canonical(lab.create_weights(text))
+    return code, lab.encode(text, lab.create_encoding(code)).tobytes()
+  def decode(code: bytes, payload: bytes) -> str:
+    decoding = lab.create_decoding(code)
+    if table: return lab.decode_table(frombytes(payload), decoding)
+    return lab.decode(frombytes(payload), decoding)
+
+  ((code, payload), encode_time) = timed(encode, text)
+  (decoded, decode_time) = timed(decode, code, payload)
+  assert decoded == text
+  return len(code) + len(payload), encode_time, decode_time
+
+def lzw(text: str, *, max_size: int | None, array: bool):
+  lab = open_lab('lab-6')
+  text = text.encode()
+  def decode(table: bytes, payload: bytes) -> bytes:
+    if array: return lab.decode_container(table, payload)
+    encoded = frombytes(payload)
+    for _ in range(lab.to_int(encoded[:3])): encoded.pop()
+    (code_len, *codes) = table
+    return lab.decode(encoded, lab.create_decoding(f"{code_len}:{':'.join(map(str, codes))}"))
+
+  ((table, payload), encode_time) = timed(lab.encode_block, text, max_size)
+  (decoded, decode_time) = timed(decode, table, payload)
+  assert decoded == text
+  return len(table) + len(payload), encode_time, decode_time
+
+def lzw_stream(text: str, *, max_size: int | None):
+  lab = open_lab('lab-6')
+  text = text.encode()
+  max_bits = max_size and ceil(log2(max_size))
+  (encoded, encode_time) = timed(lambda: b''.join(lab.encode_stream([text], max_bits)))
+  (decoded, decode_time) = timed(lambda: b''.join(lab.decode_stream([encoded])))
+  assert decoded == text
+  return len(encoded), encode_time, decode_time
+
+# Blocks are coded by a pool of processes, the cases of more processes against
+# the one of a single process give the scaling over as many cores.
+def blocks(lab: str, *, processes: int, block: int = 2 ** 18):
+  def run(text: str):
+    module = open_lab(lab)
+    data = text.encode() if lab == 'lab-6' else text
+    (encoded, encode_time) = timed(lambda: module.encode_blocks(data, block=block, processes=processes))
+    (decoded, decode_time) = timed(lambda: module.decode_blocks(encoded, processes=processes))
+    assert decoded == data
+    return sum(len(code) + len(payload) for (code, payload) in encoded), encode_time, decode_time
+  return run
+
+def builder(lab: str, function: str, *args, **kwargs):
+  def run(text: str):
+    build = getattr(open_lab(lab), function)
+    (_, elapsed) = timed(lambda: build(text, *args, **kwargs))
+    return None, elapsed, None
+  return run
+
+# Sketches read the text in chunks, as they would a file larger than memory.
+def sketched(lab: str, function: str, *args, **kwargs):
+  def run(text: str):
+    build = getattr(open_lab(lab), function)
+    data = text.encode()
+    (_, elapsed) = timed(lambda: build((data[i:i + 2 ** 16] for i in range(0, len(data), 2 ** 16)), *args, **kwargs))
+    return None, elapsed, None
+  return run
+
+cases: dict[str, Callable[[str], tuple[int | None, float, float | None]]] = {
+  'lab-4': lambda text: fixed(text, array=False),
+  'lab-4 array': lambda text: fixed(text, array=True),
+  'lab-5': lambda text: huffman(text, table=False),
+  'lab-5 table': lambda text: huffman(text, table=True),
+  **{
+    f'lab-6 {max_size or "full"}': lambda text, max_size=max_size: lzw(text, max_size=max_size, array=False)
+    for max_size in max_sizes
+  },
+  **{
+    f'lab-6 array {max_size or "full"}': lambda text, max_size=max_size: lzw(text, max_size=max_size, array=True)
+    for max_size in max_sizes
+  },
+  **{
+    f'lab-6 stream {max_size or "full"}': lambda text, max_size=max_size: lzw_stream(text, max_size=max_size)
+    for max_size in max_sizes
+  },
+  **{
+    f'{lab} blocks {processes}': blocks(lab, processes=processes)
+    for lab in ('lab-5', 'lab-6') for processes in (1, 2, 4, 8)
+  },
+  'lab-1 ngram index': builder('lab-1', 'create_ngram_index', 6),
+  'lab-2 markov model': builder('lab-2', 'create_markov_model', 3),
+  'lab-3 letter entropies': builder('lab-3', 'count_conditional_entropies', 4, kind='letters'),
+  'lab-3 word entropies': builder('lab-3', 'count_conditional_entropies', 4, kind='words'),
+  'lab-1 sketch': sketched('lab-1', 'sketch_ngrams', 6),
+  'lab-2 sketch': sketched('lab-2', 'sketch_ngram_probabilities', 3),
+  'lab-3 sketch entropies': sketched('lab-3', 'sketch_conditional_entropies', 4, kind='words'),
+}
+# endregion
+
+def run(case: str, name: str) -> dict:
+  text = readinput(name)
+  size = len(text.encode())
+  (encoded_size, encode_time, decode_time) = cases[case](text)
+  return {
+    'case': case,
+    'input': name,
+    'size': size,
+    'encode_mib_s': size / encode_time / 2 ** 20,
+    'decode_mib_s': decode_time and size / decode_time / 2 ** 20,
+    'ratio': encoded_size and encoded_size / size,
+    # Kilobytes on Linux.
+    'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+  }
+
+# Each measurement runs in a fresh process forked from this small one, so
+# that peak memory belongs to that case alone.
+def isolated(function: Callable, *args):
+  with ProcessPoolExecutor(1, mp_context=get_context('fork')) as executor:
+    return executor.submit(function, *args).result()
+
+def compare(results: list[dict], baseline: list[dict], *, tolerance: float) -> list[str]:
+  previous = {(result['case'], result['input']): result for result in baseline}
+  regressions = []
+  for result in results:
+    if (old := previous.get((result['case'], result['input']))) is None: continue
+    label = f"{result['case']} on {result['input']}"
+    for key in ('encode_mib_s', 'decode_mib_s'):
+      if old[key] and result[key] < old[key] * (1 - tolerance):
+        regressions.append(f"{label}: {key} {result[key]:.2f} < {old[key]:.2f}")
+    if old['ratio'] and result['ratio'] > old['ratio'] * (1 + 1e-9):
+      regressions.append(f"{label}: ratio {result['ratio']:.4f} > {old['ratio']:.4f}")
+    if result['peak_rss_mib'] > old['peak_rss_mib'] * (1 + tolerance):
+      regressions.append(f"{label}: peak_rss_mib {result['peak_rss_mib']:.1f} > {old['peak_rss_mib']:.1f}")
+  return regressions
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description="Throughput, memory and ratio of the lab codecs and n-gram builders.")
+  parser.add_argument('--cases', nargs='+', default=['*'], help="patterns of case names")
+  parser.add_argument('--inputs', nargs='+', default=['resources', '1K', '1M'], help=f"'resources', files or any of {', '.join(synthetic)}")
+  parser.add_argument('--output', default=os.path.join(root, 'results', 'benchmark.json'))
+  parser.add_argument('--baseline', help="results of an earlier run to fail against")
+  parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative loss of speed and memory")
+  arguments = parser.parse_args()
+
+  selected = [case for case in cases if any(fnmatch(case, pattern) for pattern in arguments.cases)]
+  inputs = find_inputs(arguments.inputs)
+  for name in inputs:
+    if name in synthetic: isolated(create_synthetic, name)
+
+  results = []
+  for name in inputs:
+    for case in selected:
+      results.append(result := isolated(run, case, name))
+      decode_speed = f"{result['decode_mib_s']:8.2f}" if result['decode_mib_s'] else f"{'-':>8}"
+      ratio = f"{result['ratio']:6.3f}" if result['ratio'] else f"{'-':>6}"
+      print(f"{case:24} {name:32} {result['encode_mib_s']:8.2f} {decode_speed} MiB/s {ratio} {result['peak_rss_mib']:8.1f} MiB", flush=True)
+
+  os.makedirs(os.path.dirname(os.path.abspath(arguments.output)), exist_ok=True)
+  with open(arguments.output, 'w') as file:
+    json.dump(results, file, indent=2)
+
+  if arguments.baseline:
+    with open(arguments.baseline) as file:
+      regressions = compare(results, json.load(file), tolerance=arguments.tolerance)
+    for regression in regressions: print(f"Regression: {regression}")
+    sys.exit(1 if regressions else 0)
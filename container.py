@@ -0,0 +1,87 @@
+from importlib.util import module_from_spec, spec_from_file_location
+import os
+import struct
+import sys
+from typing import Iterable
+import zlib
+
+# Single file holding everything a lab codec needs to decode, read front to back:
+#
+#   magic (4) | version (1) | codec (1) | length (8) | table size (4) | crc (4)
+#   table | crc (4)
+#   block size (4) | crc (4) | block ... and a block of size 0 at the end
+#
+# Numbers are big-endian, crc is CRC-32 of the bytes before it in the same
+# section. Length counts decoded symbols (letters for lab-4 and lab-5, bytes for
+# lab-6) and payload is the codec's usual stream including its 3 bit header.
+MAGIC = b'ITLC'
+VERSION = 1
+CODECS = {'lab-4': 4, 'lab-5': 5, 'lab-6': 6}
+
+header = struct.Struct('>4sBBQI')
+block_header = struct.Struct('>II')
+checksum = struct.Struct('>I')
+
+def write(
+  filename: str, codec: str, length: int, table: bytes,
+  payload: bytes | Iterable[bytes], *, block: int = 2 ** 16
+):
+  if isinstance(payload, (bytes, bytearray)): payload = [payload]
+
+  with open(filename, 'wb') as file:
+    head = header.pack(MAGIC, VERSION, CODECS[codec], length, len(table))
+    file.write(head + checksum.pack(zlib.crc32(head)))
+    file.write(table + checksum.pack(zlib.crc32(table)))
+
+    for chunk in payload:
+      for start in range(0, len(chunk), block):
+        data = chunk[start:start + block]
+        file.write(block_header.pack(len(data), zlib.crc32(data)) + data)
+    file.write(block_header.pack(0, 0))
+
+def read(filename: str) -> tuple[str, int, bytes, bytes]:
+  with open(filename, 'rb') as file:
+    def take(size: int) -> bytes:
+      data = file.read(size)
+      if len(data) != size: raise ValueError(f"{filename} is truncated")
+      return data
+
+    def verify(data: bytes, name: str):
+      (crc,) = checksum.unpack(take(checksum.size))
+      if zlib.crc32(data) != crc: raise ValueError(f"{filename} has corrupted {name}")
+
+    verify(head := take(header.size), 'header')
+    (magic, version, codec, length, table_size) = header.unpack(head)
+    if magic != MAGIC: raise ValueError(f"{filename} is not a container")
+    if version != VERSION: raise ValueError(f"{filename} has unsupported version {version}")
+    names = {id: name for (name, id) in CODECS.items()}
+    if codec not in names: raise ValueError(f"{filename} has unknown codec {codec}")
+
+    verify(table := take(table_size), 'table')
+
+    blocks = []
+    while True:
+      (size, crc) = block_header.unpack(take(block_header.size))
+      if not size: break
+      if zlib.crc32(data := take(size)) != crc:
+        raise ValueError(f"{filename} has corrupted block {len(blocks)}")
+      blocks.append(data)
+
+  return names[codec], length, table, b''.join(blocks)
+
+modules = {}
+def open_lab(codec: str):
+  if codec not in modules:
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), codec, f"{codec}.py")
+    spec = spec_from_file_location(codec.replace('-', '_'), path)
+    # Registered before running so that process pools can pickle its functions.
+    sys.modules[spec.name] = modules[codec] = module_from_spec(spec)
+    spec.loader.exec_module(modules[codec])
+  return modules[codec]
+
+def decode(filename: str) -> str | bytes:
+  (codec, length, table, payload) = read(filename)
+  decoded = open_lab(codec).decode_container(table, payload)
+  if len(decoded) != length:
+    raise ValueError(f"{filename} decoded to {len(decoded)} symbols instead of {length}")
+  return decoded
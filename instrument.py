@@ -0,0 +1,87 @@
+import atexit
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+import json
+import os
+import time
+from typing import Callable
+
+# Instrumentation is off unless the INSTRUMENT variable names a file for the
+# report or `enable` is called. Instrumented functions then only check a flag,
+# every measurement is taken after the call from its arguments and result.
+calls = []
+phases = []
+active = False
+output = None
+
+def enable(path: str = None):
+  global active, output
+  active = True
+  output = path or output
+
+def disable():
+  global active
+  active = False
+
+def measure(value) -> dict[str, int]:
+  if isinstance(value, tuple) and value: return measure(value[0])
+  if isinstance(value, str): return {'symbols': len(value), 'bytes': len(value.encode())}
+  if isinstance(value, (bytes, bytearray, memoryview)): return {'symbols': len(value), 'bytes': value.nbytes if isinstance(value, memoryview) else len(value)}
+  if hasattr(value, 'nbytes'): return {'bytes': value.nbytes}
+  return {}
+
+def timed(name: str, *, argument: int | None = 0, output: bool = True, stats: Callable[..., dict] = None):
+  def decorate(function: Callable) -> Callable:
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+      if not active: return function(*args, **kwargs)
+
+      start = time.perf_counter()
+      result = function(*args, **kwargs)
+      seconds = time.perf_counter() - start
+
+      entry = {
+        'name': name,
+        'seconds': seconds,
+        'in': measure(args[argument]) if argument is not None and len(args) > argument else {},
+        'out': measure(result) if output else {},
+      }
+      if (symbols := max(entry['in'].get('symbols', 0), entry['out'].get('symbols', 0))) and seconds:
+        entry['symbols_per_second'] = symbols / seconds
+      if stats: entry.update(stats(result, *args, **kwargs))
+      calls.append(entry)
+      return result
+    return wrapper
+  return decorate
+
+@contextmanager
+def recording(name: str):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    phases.append({'name': name, 'seconds': time.perf_counter() - start})
+
+def phase(name: str):
+  return recording(name) if active else nullcontext()
+
+def report() -> dict:
+  summary = {}
+  for entry in calls:
+    total = summary.setdefault(entry['name'], {'calls': 0, 'seconds': 0, 'symbols': 0, 'bytes_in': 0, 'bytes_out': 0})
+    total['calls'] += 1
+    total['seconds'] += entry['seconds']
+    total['symbols'] += max(entry['in'].get('symbols', 0), entry['out'].get('symbols', 0))
+    total['bytes_in'] += entry['in'].get('bytes', 0)
+    total['bytes_out'] += entry['out'].get('bytes', 0)
+  for total in summary.values():
+    total['symbols_per_second'] = total['symbols'] / total['seconds'] if total['symbols'] and total['seconds'] else None
+
+  return {'summary': summary, 'calls': calls, 'phases': phases}
+
+def save(path: str):
+  with open(path, 'w') as file:
+    json.dump(report(), file, indent=2)
+
+if path := os.environ.get('INSTRUMENT'): enable(path)
+atexit.register(lambda: active and output and save(output))
@@ -1,6 +1,17 @@
+from bisect import bisect
+from codecs import getincrementaldecoder
 from collections import Counter
+import os
 import random
-from typing import Literal
+import sys
+import time
+from typing import Iterable, Iterator, Literal
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+import sketch
 
 alphabet_weights = Counter(' abcdefghijklmnopqrstuvwxyz')
 def readfile(filename: Literal['hamlet', 'romeo', 'wiki_sample']):
@@ -22,6 +33,7 @@ def normalize(weights: dict):
   for key in weights: weights[key] /= total
   return weights
 
+@instrument.timed('lab-1 calculate_conditional_weights', stats=lambda weights, *_: {'contexts': len(weights)})
 def calculate_conditional_weights(text: str, n: int):
   conditional_weights = {}
   ngrams = create_ngrams(text, n)
@@ -39,6 +51,66 @@ def calculate_conditional_weights(text: str, n: int):
 
   return conditional_weights
 
+@instrument.timed('lab-1 create_ngram_index', stats=lambda index, *_: {'alphabet': len(index[0]), 'ngrams': [len(keys) for (keys, _) in index[1]]})
+def create_ngram_index(text: str, n: int):
+  # Every n-gram is kept as a number written in base of the alphabet size,
+  # so all of the orders are counted from one array of symbols and a longer
+  # n-gram is built from a shorter one without going through the text again.
+  (alphabet, symbols) = np.unique(np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32), return_inverse=True)
+  if len(alphabet) ** n > np.iinfo(np.int64).max:
+    raise ValueError(f"{n}-grams of {len(alphabet)} symbols do not fit in 64 bits.")
+
+  index = []
+  keys = np.zeros(len(symbols) + 1, dtype=np.int64)
+  for i in range(n):
+    keys = keys[:-1] * len(alphabet) + symbols[i:]
+    index.append(np.unique(keys, return_counts=True))
+  return alphabet, index
+
+def ngram_labels(alphabet: np.ndarray, keys: np.ndarray, n: int) -> list[str]:
+  digits = keys[:, None] // len(alphabet) ** np.arange(n - 1, -1, -1) % len(alphabet)
+  labels = alphabet[digits].astype(np.uint32).tobytes().decode('utf-32-le')
+  return [labels[i:i + n] for i in range(0, len(labels), n)]
+
+def ngrams_from_index(index: tuple[np.ndarray, list], n: int = 1):
+  (alphabet, index) = index
+  (keys, counts) = index[n - 1]
+  return normalize(dict(zip(ngram_labels(alphabet, keys, n), counts.tolist())))
+
+def conditional_weights_from_index(index: tuple[np.ndarray, list], n: int):
+  (alphabet, orders) = index
+  (keys, _) = orders[n - 1]
+  (next_keys, next_counts) = orders[n]
+
+  # Only letters of the alphabet are followed, same as in `calculate_conditional_weights`.
+  letters = np.isin(alphabet, np.array(list(map(ord, alphabet_weights)), dtype=alphabet.dtype))
+  followed = letters[next_keys % len(alphabet)]
+  (next_keys, next_counts) = (next_keys[followed], next_counts[followed])
+
+  (prefixes, starts, totals) = np.unique(next_keys // len(alphabet), return_index=True, return_counts=True)
+  weights = next_counts / np.repeat(np.add.reduceat(next_counts, starts), totals) if len(next_counts) else next_counts
+
+  conditional_weights = dict.fromkeys(ngram_labels(alphabet, keys, n))
+  for ngram in conditional_weights: conditional_weights[ngram] = {}
+  letters = ngram_labels(alphabet, next_keys % len(alphabet), 1)
+  for (ngram, start, total) in zip(ngram_labels(alphabet, prefixes, n), starts.tolist(), totals.tolist()):
+    conditional_weights[ngram] = dict(zip(letters[start:start + total], weights[start:start + total].tolist()))
+
+  return conditional_weights
+
+def stream_letters(chunks: Iterable[bytes]) -> Iterator[str]:
+  decoder = getincrementaldecoder('utf-8')()
+  for chunk in chunks:
+    if text := decoder.decode(chunk): yield text
+  if text := decoder.decode(b'', final=True): yield text
+
+@instrument.timed('lab-1 sketch_ngrams', argument=None, output=False, stats=lambda ngrams, *_, **__: {'ngrams': ngrams.total, 'sketch_bytes': ngrams.nbytes})
+def sketch_ngrams(chunks: Iterable[bytes], n: int = 1, **options) -> sketch.NgramSketch:
+  # Same n-grams as `create_ngrams` in a fixed amount of memory, with counts
+  # instead of weights, see `sketch.NgramSketch` for the options and bounds.
+  [ngrams] = sketch.count(stream_letters(chunks), n, **options)
+  return ngrams
+
 def create_markov_chain_sentences(n: int, degree: int, start: str, weights: dict):
   result = start
   while len(result) < n and (ngram := result[-degree:]):
@@ -51,6 +123,96 @@ def create_markov_chain_sentences(n: int, degree: int, start: str, weights: dict
 
   return result
 
+@instrument.timed('lab-1 create_markov_model', argument=None, stats=lambda model, *_: {'contexts': len(model[1])})
+def create_markov_model(weights: dict[str, dict[str, float]], degree: int):
+  # Every context with known weights gets a row of cumulative weights over the
+  # letters and a row of contexts each of the letters leads to, -1 standing
+  # for a context without weights where letters are drawn from the alphabet.
+  letters = ''.join(alphabet_weights)
+  contexts = {ngram: i for (i, ngram) in enumerate(ngram for ngram in weights if weights[ngram])}
+  followers = [[j for (j, letter) in enumerate(letters) if weights[ngram].get(letter, 0) > 0] for ngram in contexts]
+
+  cumulative = np.ones((len(contexts), len(letters)))
+  transitions = np.full((len(contexts), len(letters)), -1, dtype=np.int64)
+  for (ngram, i) in contexts.items():
+    row = np.array([weights[ngram].get(letter, 0) for letter in letters])
+    # Bounds from the last letter with weight on are 1, so letters after it
+    # are never drawn even when rounding leaves the sum short of 1.
+    last = followers[i][-1]
+    cumulative[i, :last] = np.cumsum(row)[:last] / row.sum()
+    for (j, letter) in enumerate(letters):
+      transitions[i, j] = contexts.get((ngram + letter)[-degree:], -1)
+
+  # Single chains walk rows holding only the letters which may follow, each
+  # with the letters forced after it, up to the context where there is a
+  # choice again, so a draw is made only where there is one.
+  def forced(state: int) -> tuple[bytes, int]:
+    (run, seen) = (bytearray(), set())
+    while state >= 0 and len(followers[state]) == 1 and state not in seen:
+      seen.add(state)
+      [j] = followers[state]
+      run.append(j)
+      state = int(transitions[state, j])
+    return bytes(run), state
+
+  rows = []
+  for (row, drawn, transition) in zip(cumulative.tolist(), followers, transitions.tolist()):
+    (runs, targets) = zip(*((bytes([j]) + run, target) for j in drawn for (run, target) in [forced(transition[j])]))
+    rows.append(([row[j] for j in drawn[:-1]], runs, targets))
+
+  return degree, contexts, cumulative, transitions, rows
+
+def generate_markov_chain(model, n: int, start: str, *, seed: int = None) -> str:
+  return generate_markov_chains(model, n, start, seed=seed)[0]
+
+def generate_markov_chains(model, n: int, start: str, *, seed: int = None, chains: int = 1) -> list[str]:
+  (degree, contexts, cumulative, transitions, rows) = model
+  letters = ''.join(alphabet_weights)
+  table = bytes.maketrans(bytes(range(len(letters))), letters.encode())
+  fallback = np.cumsum(list(alphabet_weights.values()))[:-1] / alphabet_weights.total()
+
+  rng = np.random.default_rng(seed)
+  count = max(n - len(start), 0)
+
+  def context(generated: bytes | bytearray) -> int:
+    tail = generated[max(0, len(generated) - degree):].translate(table).decode()
+    return contexts.get((start + tail)[-degree:], -1)
+
+  if chains == 1:
+    # A letter depends on the ones before it, so a single chain is walked a
+    # draw at a time, at about 2 million letters a second for degree 5 on
+    # Hamlet. Many chains at once are advanced in arrays instead.
+    (fallback, buffer) = (fallback.tolist(), bytearray())
+    state = contexts.get(start[-degree:], -1)
+    for draw in rng.random(count).tolist():
+      if len(buffer) >= count: break
+      if state < 0:
+        buffer.append(bisect(fallback, draw))
+        state = context(buffer)
+        continue
+      (row, runs, targets) = rows[state]
+      i = bisect(row, draw)
+      buffer += runs[i]
+      state = targets[i]
+    del buffer[count:]
+  else:
+    # Chains are advanced all at once, a step at a time.
+    buffer = bytearray(chains * count)
+    view = np.frombuffer(buffer, dtype=np.uint8).reshape(chains, count)
+    states = np.full(chains, contexts.get(start[-degree:], -1), dtype=np.int64)
+    for position in range(count):
+      draws = rng.random(chains)
+      known = states >= 0
+      drawn = (cumulative[states[known], :-1] <= draws[known, None]).sum(axis=1)
+      view[known, position] = drawn
+      states[known] = transitions[states[known], drawn]
+      for chain in np.flatnonzero(~known).tolist():
+        view[chain, position] = np.searchsorted(fallback, draws[chain], side='right')
+        states[chain] = context(view[chain, max(0, position + 1 - degree):position + 1].tobytes())
+
+  generated = buffer.translate(table).decode()
+  return [start + generated[i:i + count] for i in range(0, chains * count, count)] if count else [start] * chains
+
 if __name__ == '__main__':
   print()
   print("1. Zero degree.")
@@ -59,14 +221,15 @@ if __name__ == '__main__':
   print(f"Average gibberish word length: {average_length(gibberish_text)}")
 
   text = readfile('hamlet')
+  index = create_ngram_index(text, 6)
 
   print()
   print("2. Letter weights.")
-  print(create_ngrams(text, 1))
+  print(ngrams_from_index(index, 1))
 
   print()
   print("3. First degree.")
-  weights = create_ngrams(text, 1)
+  weights = ngrams_from_index(index, 1)
   first_degree_text = ''.join(generate_letters(n=10000, weights=weights))
 
   print(f'Generated average word length: {average_length(first_degree_text)}')
@@ -77,7 +240,7 @@ if __name__ == '__main__':
   common = Counter(text).most_common(2)
   print(f"Most common: {common}")
 
-  conditional_weights = calculate_conditional_weights(text, 1)
+  conditional_weights = conditional_weights_from_index(index, 1)
   for (letter, _) in common: print(f"Weights after {letter}: \n{conditional_weights[letter]}")
 
   print()
@@ -85,9 +248,33 @@ if __name__ == '__main__':
   for degree in [1, 3, 5]:
     print(f"- degree: {degree}")
 
-    weights = calculate_conditional_weights(text, degree)
+    weights = conditional_weights_from_index(index, degree)
     n_degree_text = create_markov_chain_sentences(n=10000, degree=degree, start='probability', weights=weights)
 
     print(f"Generated text: {n_degree_text[:100]}...")
     print(f"Average word length: {average_length(n_degree_text)}")
     print()
+
+  print("6. Compiled Markov approximations.")
+  for degree in [1, 3, 5]:
+    print(f"- degree: {degree}")
+
+    model = create_markov_model(conditional_weights_from_index(index, degree), degree)
+    start = time.perf_counter()
+    n_degree_text = generate_markov_chain(model, n=1_000_000, start='probability', seed=degree)
+    elapsed = time.perf_counter() - start
+
+    print(f"Generated text: {n_degree_text[:100]}...")
+    print(f"Average word length: {average_length(n_degree_text)}")
+    print(f"Characters per second: {len(n_degree_text) / elapsed:.0f}")
+    print()
+
+  print("7. Sketched n-grams.")
+  for n in [1, 3, 5]:
+    with open("resources/norm_hamlet.txt", 'rb') as file:
+      ngrams = sketch_ngrams(iter(lambda: file.read(2 ** 16), b''), n)
+    (distinct, error) = ngrams.count_distinct()
+    (estimate, low, high) = ngrams.entropy()
+    print(f"- {n}-grams in {ngrams.nbytes / 2 ** 20:.1f} MiB: {distinct:.0f} distinct (±{error * 100:.1f}%, exactly {len(index[1][n - 1][0])})")
+    print(f"Most common (counts at most {ngrams.error:.0f} over): {ngrams.most_common(5)}")
+    print(f"Entropy: {estimate:.3f} bits, between {low:.3f} and {high:.3f}")
@@ -1,6 +1,17 @@
+from bisect import bisect_left
+from codecs import getincrementaldecoder
 from collections import Counter
+import os
 import random
-from typing import Iterable, Literal
+import sys
+from typing import Iterable, Iterator, Literal
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+import ngrams
+import sketch
 
 def readfile(filename: Literal['hamlet', 'romeo', 'wiki_sample']):
   with open(f"resources/norm_{filename}.txt") as file:
@@ -24,6 +35,7 @@ def normalize(weights: dict):
 def generate_words(weights: dict, *, k: int = 1):
   return random.choices(tuple(weights), weights=weights.values(), k=k)
 
+@instrument.timed('lab-2 calculate_conditional_weights', stats=lambda weights, *_: {'contexts': len(weights)})
 def calculate_conditional_weights(text: str, degree: int):
   conditional_weights = {}
   ngrams = create_ngram_probabilities(text, degree)
@@ -39,11 +51,39 @@ def calculate_conditional_weights(text: str, degree: int):
 
   return conditional_weights
 
+@instrument.timed('lab-2 create_ngram_probabilities', stats=lambda probabilities, *_, **__: {'ngrams': len(probabilities)})
 def create_ngram_probabilities(text: str, degree: int):
   words = text.split(' ')
   if degree == 0: return normalize(Counter(words))
   return normalize(Counter(tuple(words[i:i + degree]) for i in range(len(words) - degree + 1)))
 
+def stream_words(chunks: Iterable[bytes]) -> Iterator[list[str]]:
+  # Words are split as by `text.split(' ')`, the last one may continue in the
+  # next chunk.
+  decoder = getincrementaldecoder('utf-8')()
+  rest = ''
+  for chunk in chunks:
+    (*words, rest) = (rest + decoder.decode(chunk)).split(' ')
+    if words: yield words
+  yield (rest + decoder.decode(b'', final=True)).split(' ')
+
+@instrument.timed('lab-2 sketch_ngram_probabilities', argument=None, output=False, stats=lambda ngrams, *_, **__: {'ngrams': ngrams.total, 'sketch_bytes': ngrams.nbytes})
+def sketch_ngram_probabilities(chunks: Iterable[bytes], degree: int, **options) -> sketch.NgramSketch:
+  # Counts of the n-grams of `create_ngram_probabilities` kept in a fixed
+  # amount of memory, see `sketch.NgramSketch` for the options and bounds.
+  [ngrams] = sketch.count(stream_words(chunks), degree, **options)
+  return ngrams
+
+def create_vocabulary(text: str) -> tuple[list[str], np.ndarray]:
+  return ngrams.create_vocabulary(text.split(' '))
+
+@instrument.timed('lab-2 create_packed_ngrams', stats=lambda packed, *_, **__: {'ngrams': len(packed[0])})
+def create_packed_ngrams(text: str, degree: int, *, vocabulary: tuple[list[str], np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+  # Counts of the n-grams of `create_ngram_probabilities` next to their packed
+  # keys, see `ngrams.pack_ngrams`.
+  (words, ids) = vocabulary or create_vocabulary(text)
+  return ngrams.pack_ngrams(ids, degree, ngrams.count_bits(words))
+
 def create_markov_chain_sentences(text: str, degree: int, *, k: int = 10, start: list[str] = None):
   ngram = start or generate_words(create_ngram_probabilities(text, 0))
 
@@ -62,6 +102,72 @@ def create_markov_chain_sentences(text: str, degree: int, *, k: int = 10, start:
 
   return ' '.join(result)
 
+@instrument.timed('lab-2 create_markov_model', stats=lambda model, *_: {'vocabulary': len(model['offsets']) - 1, 'model_bytes': sum(array.nbytes for array in model.values())})
+def create_markov_model(text: str, degree: int):
+  # Words are kept as ids into a sorted vocabulary, stored as one utf-8 blob
+  # with offsets. For every order up to `degree` there are the sorted contexts,
+  # where the words following each of them start, those words and the running
+  # count of each one within its context.
+  (vocabulary, words) = create_vocabulary(text)
+  encoded = [word.encode() for word in vocabulary]
+  offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+  np.cumsum(list(map(len, encoded)), out=offsets[1:])
+  model = {'vocabulary': np.frombuffer(b''.join(encoded), dtype=np.uint8), 'offsets': offsets}
+
+  for order in range(degree + 1):
+    (ngrams, counts) = np.unique(np.lib.stride_tricks.sliding_window_view(words, order + 1), axis=0, return_counts=True)
+    changes = np.flatnonzero((ngrams[1:, :order] != ngrams[:-1, :order]).any(axis=1)) + 1
+    starts = np.concatenate(([0], changes, [len(ngrams)]))
+    cumulative = np.cumsum(counts)
+    cumulative -= np.repeat(np.concatenate(([0], cumulative[changes - 1])), np.diff(starts))
+
+    model[f'{order}-contexts'] = np.ascontiguousarray(ngrams[starts[:-1], :order])
+    model[f'{order}-starts'] = starts
+    model[f'{order}-successors'] = np.ascontiguousarray(ngrams[:, order])
+    model[f'{order}-cumulative'] = cumulative
+  return model
+
+def save_markov_model(model: dict[str, np.ndarray], name: str):
+  os.makedirs(f'results/{name}', exist_ok=True)
+  for (key, array) in model.items(): np.save(f'results/{name}/{key}.npy', array)
+
+def load_markov_model(name: str) -> dict[str, np.ndarray]:
+  return {
+    file.removesuffix('.npy'): np.load(f'results/{name}/{file}', mmap_mode='r')
+    for file in os.listdir(f'results/{name}') if file.endswith('.npy')
+  }
+
+def generate_markov_sentences(model: dict[str, np.ndarray], *, k: int = 10, start: list[str] = None, seed: int = None):
+  (vocabulary, offsets) = (model['vocabulary'], model['offsets'])
+  degree = sum(key.endswith('-contexts') for key in model) - 1
+  rng = np.random.default_rng(seed)
+
+  def word(i: int) -> str:
+    return bytes(vocabulary[offsets[i]:offsets[i + 1]]).decode()
+
+  def find(context: list[int]) -> int | None:
+    contexts = model[f'{len(context)}-contexts']
+    (low, high) = (0, len(contexts))
+    for (column, id) in enumerate(context):
+      values = contexts[low:high, column]
+      (low, high) = (low + np.searchsorted(values, id, 'left'), low + np.searchsorted(values, id, 'right'))
+    return low if low < high else None
+
+  # Contexts not followed by any word are shortened until one is found.
+  def generate(context: list[int]) -> int:
+    while (row := find(context)) is None: context = context[1:]
+    (start, end) = model[f'{len(context)}-starts'][row:row + 2]
+    cumulative = model[f'{len(context)}-cumulative'][start:end]
+    return int(model[f'{len(context)}-successors'][start + np.searchsorted(cumulative, rng.integers(cumulative[-1]), 'right')])
+
+  ids = [bisect_left(range(len(offsets) - 1), item, key=word) for item in start or []]
+  for (item, id) in zip(start or [], ids):
+    if id == len(offsets) - 1 or word(id) != item: raise KeyError(item)
+  while len(ids) < max(degree, 1): ids.append(generate(ids))
+  for _ in range(k): ids.append(generate(ids[len(ids) - degree:] if degree else []))
+
+  return ' '.join(map(word, ids))
+
 if __name__ == '__main__':
   [hamlet_text, romeo_text, wiki_sample_text] = map(readfile, ['hamlet', 'romeo', 'wiki_sample'])
   wiki_sample_text = wiki_sample_text
@@ -96,3 +202,19 @@ if __name__ == '__main__':
   print()
   print('- Second degree approximations with a starting point:')
   print(create_markov_chain_sentences(wiki_sample_text, 2, k=42, start=['probability']))
+
+  print()
+  print('- Second degree approximations from a saved model:')
+  save_markov_model(create_markov_model(wiki_sample_text, 2), 'wiki_sample_2')
+  model = load_markov_model('wiki_sample_2')
+  print(generate_markov_sentences(model, k=42, start=['probability']))
+
+  print()
+  print("4. Sketched word frequencies.")
+  with open("resources/norm_wiki_sample.txt", 'rb') as file:
+    sketched = sketch_ngram_probabilities(iter(lambda: file.read(2 ** 16), b''), 0)
+  (distinct, error) = sketched.count_distinct()
+  print(f"Total unique words: {distinct:.0f} (±{error * 100:.1f}%, exactly {len(words)}) in {sketched.nbytes / 2 ** 20:.1f} MiB")
+  print(f"10 Most common words (counts at most {sketched.error:.0f} over): {sketched.most_common(10)}")
+  (estimate, low, high) = sketched.entropy()
+  print(f"Entropy: {estimate:.3f} bits, between {low:.3f} and {high:.3f}")
@@ -1,6 +1,19 @@
-from collections import defaultdict
+from codecs import getincrementaldecoder
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import json
 import math
-from typing import Iterable, Literal, Counter
+import os
+import sys
+from typing import Iterable, Iterator, Literal, Counter
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import instrument
+import ngrams
+import sketch
 
 def readfile(filename: Literal[
   'wiki_en', 'wiki_eo', 'wiki_et', 'wiki_ht', 'wiki_la', 'wiki_nv', 'wiki_so',
@@ -52,11 +65,25 @@ def conditional_entropy(weights, conditional_weights, *, base: int) -> float:
 def conditional_bit_entropy(weights, conditional_weights) -> float:
   return conditional_entropy(weights, conditional_weights, base=2)
 
+@instrument.timed('lab-3 create_ngram_weights', stats=lambda weights, *_, **__: {'ngrams': len(weights)})
 def create_ngram_weights(text: str, degree: int, *, kind: Literal['letters', 'words']):
   items = text if kind == 'letters' else text.split()
   if degree == 0: return normalize(Counter[any](items))
   return normalize(Counter[any](tuple(items[i:i + degree]) for i in range(len(items) - degree + 1)))
 
+def create_vocabulary(text: str, *, kind: Literal['letters', 'words']) -> tuple[list[str], np.ndarray]:
+  return ngrams.create_vocabulary(text if kind == 'letters' else text.split())
+
+@instrument.timed('lab-3 create_packed_ngrams', stats=lambda packed, *_, **__: {'ngrams': len(packed[0])})
+def create_packed_ngrams(
+  text: str, degree: int, *, kind: Literal['letters', 'words'], vocabulary: tuple[list[str], np.ndarray] = None
+) -> tuple[np.ndarray, np.ndarray]:
+  # Counts of the n-grams of `create_ngram_weights` next to their packed keys,
+  # see `ngrams.pack_ngrams`.
+  (items, ids) = vocabulary or create_vocabulary(text, kind=kind)
+  return ngrams.pack_ngrams(ids, degree, ngrams.count_bits(items))
+
+@instrument.timed('lab-3 calculate_conditional_weights', stats=lambda weights, *_, **__: {'contexts': len(weights)})
 def calculate_conditional_weights(text, degree, *, kind: Literal['letters', 'words']):
   if degree == 0: return create_ngram_weights(text, degree, kind=kind)
   conditional_weights = {}
@@ -71,6 +98,32 @@ def calculate_conditional_weights(text, degree, *, kind: Literal['letters', 'wor
 
   return conditional_weights
 
+def create_symbols(text: str, *, kind: Literal['letters', 'words']) -> np.ndarray:
+  return create_vocabulary(text, kind=kind)[1].astype(np.int64)
+
+@instrument.timed('lab-3 count_conditional_entropies')
+def count_conditional_entropies(text: str, degree: int, *, kind: Literal['letters', 'words'], base: int = 2) -> list[float]:
+  # N-grams are numbered from the number of their first n-1 items and their
+  # last item, so every order takes one pass over an array of integers and
+  # the counts of n-grams together with the counts of their prefixes give the
+  # same value as `conditional_entropy` of the weights.
+  symbols = create_symbols(text, kind=kind)
+  size = int(symbols.max(initial=0)) + 1
+  (ids, counts) = np.unique(symbols, return_inverse=True, return_counts=True)[1:]
+  probabilities = counts / len(symbols)
+  entropies = [float(-(probabilities * np.log(probabilities)).sum() / math.log(base))]
+
+  for order in range(1, degree + 1):
+    # Radix is the vocabulary size, orders may have fewer distinct n-grams.
+    pairs = ids[:-1] * size + symbols[order:]
+    (first, next_ids, next_counts) = np.unique(pairs, return_index=True, return_inverse=True, return_counts=True)[1:]
+    prefix_counts = counts[ids[first]]
+    probabilities = next_counts / len(pairs)
+    entropies.append(float(-(probabilities * np.log(probabilities / (prefix_counts / len(ids)))).sum() / math.log(base)))
+    (ids, counts) = (next_ids, next_counts)
+
+  return entropies
+
 alphabet = 'abcdefghijklmnopqrstuvwxyz 12334567890'
 alphabet_weights = create_ngram_weights(alphabet, 0, kind="letters")
 
@@ -86,79 +139,217 @@ locale_to_language_map = {
 
 degrees = (0, 1, 2, 3, 4)
 kinds = ("words", "letters")
+
+def profile_text(name: str, *, limit: int = 80_000) -> dict[str, list[float]]:
+  text = readfile(name)[:limit]
+  return {kind: count_conditional_entropies(text, max(degrees), kind=kind) for kind in kinds}
+
+def profile_texts(names: list[str], *, processes: int = None) -> dict[str, dict[str, list[float]]]:
+  with ProcessPoolExecutor(processes) as executor:
+    return dict(zip(names, executor.map(profile_text, names)))
+
+def create_profile(entropies: Iterable[dict[str, list[float]]]) -> dict[str, dict[str, list[float]]]:
+  entropies = list(entropies)
+  return {
+    kind: {
+      'mins': [min(values[kind][degree] for values in entropies) for degree in degrees],
+      'maxes': [max(values[kind][degree] for values in entropies) for degree in degrees],
+    } for kind in kinds
+  }
+
+def save_profile(profile: dict[str, dict[str, list[float]]], name: str = 'profile'):
+  os.makedirs('results', exist_ok=True)
+  with open(f"results/{name}.json", 'w') as file:
+    json.dump(profile, file, indent=2)
+
+def load_profile(name: str = 'profile') -> dict[str, dict[str, list[float]]]:
+  with open(f"results/{name}.json") as file:
+    return json.load(file)
+
+def classify(
+  entropies: dict[str, list[float]], profile: dict[str, dict[str, list[float]]], *, modifier: float = 0
+) -> dict[str, list[bool]]:
+  return {
+    kind: [
+      about_between(entropies[kind][degree], profile[kind]['mins'][degree], profile[kind]['maxes'][degree], modifier=modifier)
+      for degree in degrees
+    ] for kind in entropies
+  }
+
+def stream_symbols(chunks: Iterable[bytes], *, kind: Literal['letters', 'words']) -> Iterator[str]:
+  decoder = getincrementaldecoder('utf-8')()
+  rest = ''
+  for chunk in chunks:
+    text = decoder.decode(chunk)
+    if kind == 'letters':
+      yield from text
+      continue
+    # Words are split as by `text.split()`, the last one may continue in the
+    # next chunk unless the chunk ends in whitespace.
+    words = (rest + text).split()
+    rest = words.pop() if words and not text[-1:].isspace() else ''
+    yield from words
+  if kind == 'words':
+    yield from (rest + decoder.decode(b'', final=True)).split()
+  else:
+    yield from decoder.decode(b'', final=True)
+
+def sliding_conditional_entropies(
+  symbols: Iterable[str], degree: int, window: int, *, step: int = 1, base: int = 2
+) -> Iterator[tuple[int, list[float]]]:
+  # Entropy of n-grams is kept as the sum of c * log(c) over their counts c,
+  # so adding or removing an n-gram changes a single term, and the conditional
+  # entropy of a degree is the difference of the entropies of the neighbouring
+  # orders.
+  history = deque()
+  counts = [Counter() for _ in range(degree + 2)]
+  sums = [0.0] * (degree + 2)
+  totals = [0] * (degree + 2)
+
+  def update(ngram: tuple, delta: int):
+    n = len(ngram)
+    count = counts[n][ngram]
+    sums[n] += (count + delta) * math.log(count + delta) if count + delta else 0
+    sums[n] -= count * math.log(count) if count else 0
+    totals[n] += delta
+    if count + delta: counts[n][ngram] = count + delta
+    else: del counts[n][ngram]
+
+  def entropy(n: int) -> float:
+    return (math.log(totals[n]) - sums[n] / totals[n]) / math.log(base) if totals[n] else 0
+
+  tail = ()
+  for (position, symbol) in enumerate(symbols, start=1):
+    if len(history) == window:
+      for n in range(1, min(degree + 1, len(history)) + 1): update(tuple(islice(history, n)), -1)
+      history.popleft()
+    history.append(symbol)
+    tail = (*tail[-degree:], symbol) if degree else (symbol,)
+    for n in range(1, len(tail) + 1): update(tail[-n:], 1)
+
+    if position >= window and (position - window) % step == 0:
+      entropies = [entropy(n + 1) for n in range(degree + 1)]
+      yield position, [entropies[0], *(entropies[n] - entropies[n - 1] for n in range(1, degree + 1))]
+
+def stream_batches(chunks: Iterable[bytes], *, kind: Literal['letters', 'words'], size: int = 2 ** 16) -> Iterator[str | list[str]]:
+  symbols = stream_symbols(chunks, kind=kind)
+  while batch := list(islice(symbols, size)): yield ''.join(batch) if kind == 'letters' else batch
+
+@instrument.timed('lab-3 sketch_ngram_weights', argument=None, output=False, stats=lambda ngrams, *_, **__: {'ngrams': ngrams.total, 'sketch_bytes': ngrams.nbytes})
+def sketch_ngram_weights(chunks: Iterable[bytes], degree: int, *, kind: Literal['letters', 'words'], **options) -> sketch.NgramSketch:
+  # Counts of the n-grams of `create_ngram_weights` kept in a fixed amount of
+  # memory, letters are strings instead of tuples.
+  [ngrams] = sketch.count(stream_batches(chunks, kind=kind), degree, **options)
+  return ngrams
+
+@instrument.timed('lab-3 sketch_conditional_entropies', argument=None, output=False)
+def sketch_conditional_entropies(
+  chunks: Iterable[bytes], degree: int, *, kind: Literal['letters', 'words'], base: int = 2, **options
+) -> list[tuple[float, float, float]]:
+  # Estimate with its lower and upper bound for every degree up to `degree`,
+  # as in `count_conditional_entropies`, from one pass over the chunks.
+  orders = sketch.count(stream_batches(chunks, kind=kind), *range(1, degree + 2), **options)
+  return [sketch.conditional_entropy(orders[max(n - 1, 0):n + 1], base=base) for n in range(degree + 1)]
+
+def monitor(
+  chunks: Iterable[bytes], profile: dict[str, dict[str, list[float]]], *,
+  kind: Literal['letters', 'words'], window: int = 80_000, step: int = 10_000, modifier: float = 0
+) -> Iterator[tuple[int, list[float], bool]]:
+  symbols = stream_symbols(chunks, kind=kind)
+  for (position, entropies) in sliding_conditional_entropies(symbols, max(degrees), window, step=step):
+    verdicts = classify({kind: entropies}, profile, modifier=modifier)[kind]
+    yield position, entropies, sum(verdicts) / len(degrees) >= 0.5
+
+def verify():
+  # Counted entropies and the ones of packed counts against the ones of the
+  # weights, on texts short enough for orders to have fewer distinct n-grams
+  # than there are symbols.
+  try:
+    for text in ('e c e b b f h', 'a b a b a b c', 'abra cad abra cad abra', 'to be or not to be'):
+      for kind in kinds:
+        counted = count_conditional_entropies(text, max(degrees), kind=kind)
+        for degree in degrees:
+          weights = create_ngram_weights(text, degree + 1, kind=kind)
+          expected = conditional_bit_entropy(weights, calculate_conditional_weights(text, degree, kind=kind))
+          assert math.isclose(counted[degree], expected, abs_tol=1e-9)
+          assert math.isclose(ngrams.entropy(create_packed_ngrams(text, degree + 1, kind=kind)[1]), bit_entropy(weights), abs_tol=1e-9)
+    print('Counted entropies are correct')
+  except AssertionError:
+    print('Counted entropies are incorrect')
+
+  # Streamed words against `text.split()`, whichever the chunks are cut.
+  try:
+    data = 'to be\tor  not\nto bé '.encode()
+    for size in range(1, len(data) + 1):
+      assert list(stream_symbols((data[i:i + size] for i in range(0, len(data), size)), kind='words')) == data.decode().split()
+    print('Streamed words are correct')
+  except AssertionError:
+    print('Streamed words are incorrect')
+
 if __name__ == '__main__':
+  verify()
   print(f"1. Entropy.")
   print(f"Entropy of a english alphanumeric alphabet: {bit_entropy(alphabet_weights):.2f}")
 
   print(f"2a. Language entropy.")
-  (english_text, esperanto_text, estonian_text, somali_text, haitian_text, latin_text, navajo_text) = map(
-    lambda text: text[:80_000],
-    map(readfile, map(lambda x: f"wiki_{x}", locale_to_language_map))
-  )
+  languages = profile_texts([f"wiki_{locale}" for locale in locale_to_language_map])
 
-  (sample_0_text, sample_1_text, sample_2_text, sample_3_text, sample_4_text, sample_5_text) = map(
-    readfile, map(lambda x: f"sample{x}", range(6))
-  )
-
-  words_bit_entropy_mins = defaultdict(lambda: float('inf'))
-  words_bit_entropy_maxes = defaultdict(float)
-  letters_bit_entropy_mins = defaultdict(lambda: float('inf'))
-  letters_bit_entropy_maxes = defaultdict(float)
-  locale: str
-  language: str
-  mins: defaultdict[float]
-  maxes: defaultdict[float]
   for (locale, language) in locale_to_language_map.items():
-    text: str = locals()[f"{language}_text"]
+    text: str = readfile(f"wiki_{locale}")[:80_000]
     print(f"Conditional entropy of {language.capitalize()}.")
     print(f"- Sample of the language: {text[:100].strip()}...")
     for kind in kinds:
-      mins = locals()[f"{kind}_bit_entropy_mins"]
-      maxes = locals()[f"{kind}_bit_entropy_maxes"]
       for degree in degrees:
-        weights = create_ngram_weights(text, degree + 1, kind=kind)
-        conditional_weights = calculate_conditional_weights(text, degree, kind=kind)
-        value = conditional_bit_entropy(weights, conditional_weights)
-        mins[degree] = min(mins[degree], value)
-        maxes[degree] = max(maxes[degree], value)
-
-        print(f"  - {degree}-degree conditional bit entropy ({kind}): {value:.2f}")
+        print(f"  - {degree}-degree conditional bit entropy ({kind}): {languages[f'wiki_{locale}'][kind][degree]:.2f}")
     print()
 
+  save_profile(create_profile(languages.values()))
+  profile = load_profile()
   for kind in kinds:
-    mins = locals()[f"{kind}_bit_entropy_mins"]
-    maxes = locals()[f"{kind}_bit_entropy_maxes"]
     print(
       f"Min/Max bit entropies ({kind}) of given language:",
-      *map(lambda x: f"- {x[0]}-degree: {x[1]:.2f} - {x[2]:.2f}.", zip(degrees, mins.values(), maxes.values())),
+      *map(
+        lambda x: f"- {x[0]}-degree: {x[1]:.2f} - {x[2]:.2f}.",
+        zip(degrees, profile[kind]['mins'], profile[kind]['maxes'])
+      ),
       sep='\n'
     )
 
   print()
   print("2b. Is given sample a natural language?")
+  samples = profile_texts([f"sample{i}" for i in range(6)])
   for i in range(6):
     print(f"Sample nr. '{i}'.")
-    text: str = locals()[f"sample_{i}_text"][:80_000]
+    text: str = readfile(f"sample{i}")[:80_000]
     print(f"- Sample: {text[:100].strip()}...")
 
+    verdicts = classify(samples[f"sample{i}"], profile)
     for kind in kinds:
-      mins = locals()[f"{kind}_bit_entropy_mins"]
-      maxes = locals()[f"{kind}_bit_entropy_maxes"]
-
-      valid_count = 0
       for degree in degrees:
-        weights = create_ngram_weights(text, degree + 1, kind=kind)
-        conditional_weights = calculate_conditional_weights(text, degree, kind=kind)
-        value = conditional_bit_entropy(weights, conditional_weights)
-        print(f"  - {degree}-degree conditional bit entropy ({kind}): {value:.2f}.")
+        print(f"  - {degree}-degree conditional bit entropy ({kind}): {samples[f'sample{i}'][kind][degree]:.2f}.")
 
-        if about_between(value, mins[degree], maxes[degree]):
-          valid_count += 1
+        if verdicts[kind][degree]:
           print(f"- {degree}-degree ({kind}): Is within acceptable range.")
         else:
           print(f"- {degree}-degree ({kind}): Is not within acceptable range.")
-      if valid_count / len(degrees) >= 0.5:
+      if sum(verdicts[kind]) / len(degrees) >= 0.5:
         print(f"  - ({kind}): It appears it may be a natural language.")
       else:
         print(f"  - ({kind}): It may be not a natural language.")
     print()
+
+  print("2c. Is given stream a natural language?")
+  for i in range(6):
+    with open(f"resources/sample{i}.txt", 'rb') as file:
+      chunks = iter(lambda: file.read(2 ** 16), b'')
+      verdicts = [natural for (_, _, natural) in monitor(chunks, profile, kind='letters')]
+    print(f"- Sample nr. '{i}': {sum(verdicts)} of {len(verdicts)} windows appear to be a natural language.")
+
+  print()
+  print("2d. Sketched conditional entropy.")
+  for kind in kinds:
+    with open("resources/norm_wiki_en.txt", 'rb') as file:
+      sketched = sketch_conditional_entropies(iter(lambda: file.read(2 ** 16), b''), max(degrees), kind=kind)
+    exact = count_conditional_entropies(readfile('wiki_en'), max(degrees), kind=kind)
+    for (degree, (estimate, low, high)) in zip(degrees, sketched):
+      print(f"  - {degree}-degree ({kind}): {estimate:.2f}, between {low:.2f} and {high:.2f}, exactly {exact[degree]:.2f}")
@@ -1,12 +1,25 @@
 from collections import Counter
 from bitarray import bitarray
 from math import log2, ceil
+import numpy as np
+import os
+import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import container
+import instrument
+import mapped
+
+@instrument.timed('lab-4 create', argument=None, output=False, stats=lambda code, *_: {'table_symbols': len(code)})
 def create(frequencies: dict[str, int]) -> str:
   return ''.join(sorted(frequencies, key=frequencies.get, reverse=True))
 
+def count_bits(code: str) -> int:
+  # Single symbol still takes a bit, the same as `f"{0:00b}"` gives it.
+  return max(ceil(log2(len(code))), 1)
+
 def create_encoding(code: str) -> dict[str, str]:
-  required_bits = ceil(log2(len(code)))
+  required_bits = count_bits(code)
   return {letter: f"{i:0{required_bits}b}" for (i, letter) in enumerate(code)}
 
 def create_decoding(code: str) -> dict[str, str]:
@@ -16,6 +29,7 @@ def readfile(filename: str) -> str:
   with open(filename, 'r') as file:
     return file.read()
 
+@instrument.timed('lab-4 encode')
 def encode(text: str, encoding: dict[str, str]):
   encoded = bitarray(''.join(map(encoding.get, text)))
 
@@ -28,6 +42,7 @@ def encode(text: str, encoding: dict[str, str]):
 
   return encoded
 
+@instrument.timed('lab-4 decode')
 def decode(encoded: bitarray, decoding: dict[str, str]):
   decoded = ''
   code_length = len(tuple(decoding)[0])
@@ -39,13 +54,70 @@ def decode(encoded: bitarray, decoding: dict[str, str]):
     decoded += decoding[encoded[i:i + code_length].to01()]
   return decoded
 
+@instrument.timed('lab-4 encode_array')
+def encode_array(text: str, code: str, *, block: int = 2 ** 22) -> bitarray:
+  required_bits = count_bits(code)
+  points = np.array(list(map(ord, code)), dtype=np.uint32)
+  # Letters missing from the code are marked with the code's length.
+  dtype = np.min_scalar_type(len(code))
+  indices = np.full(int(points.max()) + 1, len(code), dtype=dtype)
+  indices[points] = np.arange(len(code), dtype=dtype)
+  shifts = np.arange(required_bits - 1, -1, -1, dtype=dtype)
+
+  # It's to add extra space at the end of the encoding so its
+  # length is a multiple of byte.
+  length = 3 + len(text) * required_bits
+  offset = -length % 8
+  carry = np.array([offset >> 2 & 1, offset >> 1 & 1, offset & 1], dtype=np.uint8)
+
+  # Text is packed a block at a time, bits which do not fill up a whole
+  # byte are carried over to the next block.
+  packed = []
+  for start in range(0, len(text), block):
+    letters = np.frombuffer(text[start:start + block].encode('utf-32-le'), dtype=np.uint32)
+    symbols = indices[np.minimum(letters, len(indices) - 1)]
+    if (missing := np.flatnonzero((letters >= len(indices)) | (symbols == len(code)))).size:
+      raise ValueError(f"{text[start + missing[0]]!r} is not in the code.")
+    bits = np.concatenate((carry, (symbols[:, None] >> shifts & 1).astype(np.uint8).ravel()))
+    whole = len(bits) - len(bits) % 8
+    packed.append(np.packbits(bits[:whole]).tobytes())
+    carry = bits[whole:]
+  packed.append(np.packbits(carry).tobytes())
+
+  (encoded := bitarray()).frombytes(b''.join(packed))
+  del encoded[length:]
+  return encoded
+
+@instrument.timed('lab-4 decode_array')
+def decode_array(encoded: bitarray, code: str, *, block: int = 2 ** 22) -> str:
+  required_bits = count_bits(code)
+  points = np.array(list(map(ord, code)), dtype=np.uint32)
+  weights = 1 << np.arange(required_bits - 1, -1, -1, dtype=np.uint32)
+
+  # It's to prevent extra symbol from the overflow of the last byte.
+  position = 3
+  offset = int(encoded[:position].to01(), 2)
+  count = -(-(len(encoded) - offset - position) // required_bits)
+  data = np.frombuffer(encoded.tobytes() + bytes(required_bits), dtype=np.uint8)
+
+  decoded = []
+  for start in range(0, count, block):
+    size = min(block, count - start)
+    first = position + start * required_bits
+    bits = np.unpackbits(data[first // 8:(first + size * required_bits + 7) // 8 + 1])
+    bits = bits[first % 8:first % 8 + size * required_bits].reshape(size, required_bits)
+    decoded.append(points[bits @ weights].tobytes().decode('utf-32-le'))
+  return ''.join(decoded)
+
+@instrument.timed('lab-4 save')
 def save(encoded: bitarray, code: str, name: str):
   with open(f'results/{name}.encoded', 'wb') as file:
-    file.write(encoded)
+    file.write(encoded.tobytes())
 
   with open(f'results/{name}.code', 'w') as file:
     file.write(code)
 
+@instrument.timed('lab-4 load', argument=None)
 def load(name: str):
   with open(f"results/{name}.encoded", 'rb') as file:
     (encoded := bitarray()).fromfile(file)
@@ -55,6 +127,46 @@ def load(name: str):
 
   return encoded, code
 
+def save_container(encoded: bitarray, code: str, name: str, length: int):
+  container.write(f'results/{name}.container', 'lab-4', length, code.encode(), encoded.tobytes())
+
+def decode_container(table: bytes, payload: bytes) -> str:
+  (encoded := bitarray()).frombytes(payload)
+  return decode_array(encoded, table.decode())
+
+@instrument.timed('lab-4 encode_file', argument=None, stats=lambda result, *_, **__: {'bits': result[0]})
+def encode_file(filename: str, name: str, *, size: int = 2 ** 20):
+  with instrument.phase('lab-4 encode_file counting'):
+    frequencies = mapped.count_letters(mapped.mapletters(filename, size))
+  code = create(frequencies)
+  codes = mapped.create_mapped_codes(create_encoding(code))
+
+  with open(f"results/{name}.code", 'w') as file:
+    file.write(code)
+
+  # Only whole bytes are written while encoding, the offset is not known
+  # until the end so its bits are filled in once everything is written.
+  length = 0
+  with instrument.phase('lab-4 encode_file encoding'), open(f"results/{name}.encoded", 'w+b') as file:
+    encoded = bitarray('000')
+    for chunk in mapped.mapletters(filename, size):
+      encoded.encode(codes, chunk)
+      whole = len(encoded) - len(encoded) % 8
+      file.write(encoded[:whole].tobytes())
+      del encoded[:whole]
+      length += whole
+    length += len(encoded)
+    file.write(encoded.tobytes())
+
+    offset = -length % 8
+    file.seek(0)
+    first = file.read(1)
+    if first:
+      file.seek(0)
+      file.write(bytes([first[0] | offset << 5]))
+
+  return length, code
+
 def verify():
   try:
     original = 'test text'
@@ -66,8 +178,18 @@ def verify():
   except AssertionError:
     print('Encoding and decoding is incorrect')
 
+def verify_missing():
+  # Letters outside the code are an error naming the first of them.
+  for (text, letter) in (('ab?', '?'), ('abc', 'c')):
+    try:
+      encode_array(text, 'ab')
+      print(f'Encoding of {text!r} is incorrect, no error was raised')
+    except ValueError as error:
+      print(f'Encoding of {text!r} is {"correct" if str(error) == f"{letter!r} is not in the code." else "incorrect"}: {error}')
+
 if __name__ == '__main__':
   verify()
+  verify_missing()
   original = readfile('resources/norm_wiki_sample.txt')[:80000]
 
   filename = 'test'
@@ -79,6 +201,12 @@ if __name__ == '__main__':
   encoded, code = load(filename)
   decoded = decode(encoded, create_decoding(code))
   assert original == decoded
+  assert encode_array(original, code).tobytes() == encoded.tobytes()
+  assert decode_array(encoded, code) == decoded
+  assert decode_container(b'a', encode_array('aaa', 'a').tobytes()) == 'aaa'
+
+  save_container(encoded, code, filename, len(original))
+  assert container.decode(f'results/{filename}.container') == original
 
   print()
   print(f"original text: {original[:100]}...")
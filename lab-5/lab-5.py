@@ -1,10 +1,23 @@
+from bisect import bisect_left, bisect_right
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+from itertools import repeat
 import math
+import os
+import struct
+import sys
+import time
 from typing import Iterable, Literal
 
 from bitarray import bitarray
 import operator
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import container
+import instrument
+import mapped
+
 alphanumeric = ' abcdefghijklmnopqrstuvwxyz0123456789'
 
 def readfile(filename: str, mode: Literal['r', 'rb', 'r+b'] = 'r') -> str:
@@ -29,7 +42,30 @@ def calculate_average_length(weights: dict[str, float], encoding: dict[str, str]
 def create_weights(text: str):
   return normalize(Counter(text))
 
-def create(weights: dict[str, float]) -> dict[str, float]:
+def create_lengths(weights: dict[str, float], max_length: int) -> dict[str, int]:
+  # Package-merge: leaves sorted by weight are merged with the packages made
+  # of pairs of the previous list, once for every bit of the longest code.
+  # Each symbol gets as many bits as the number of times it shows up in the
+  # 2n - 2 lightest items, which is the optimal code no longer than the limit.
+  if len(weights) > 2 ** max_length:
+    raise ValueError(f"{len(weights)} symbols do not fit in codes of {max_length} bits.")
+
+  leaves = sorted(((weight, (symbol,)) for (symbol, weight) in weights.items()), key=operator.itemgetter(0))
+  items = leaves
+  for _ in range(max_length - 1):
+    packages = [(left[0] + right[0], left[1] + right[1]) for (left, right) in zip(items[::2], items[1::2])]
+    items = list(heapq.merge(leaves, packages, key=operator.itemgetter(0)))
+
+  lengths = Counter(symbol for (_, symbols) in items[:2 * len(leaves) - 2] for symbol in symbols)
+  return {symbol: lengths[symbol] for symbol in weights}
+
+def create_codewords(weights: dict[str, float], max_length: int = None) -> dict[str, str]:
+  # Single symbol still gets a bit, a code of no bits can not be counted.
+  if len(weights) == 1: return dict.fromkeys(weights, '0')
+  if max_length is not None:
+    lengths = create_lengths(weights, max_length)
+    return create_canonical_encoding(sorted(lengths.items(), key=lambda x: (x[1], x[0])))
+
   sorted_weights = dict(sorted(weights.items(), key=operator.itemgetter(1), reverse=False))
   class Node(object):
     def __init__(self, label=None, probability=None, left=None, right=None):
@@ -41,16 +77,22 @@ def create(weights: dict[str, float]) -> dict[str, float]:
         self.label = label
         self.probability = probability
       elif left and right:
-        self.label = left.label + right.label
+        self.label = None
         self.probability = left.probability + right.probability
 
     @classmethod
     def from_weights(cls, weights: dict[str, float]):
-      nodes = list(map(lambda x: cls(*x), weights.items()))
-      while len(nodes) > 1:
-        nodes.sort(key=lambda x: x.probability)
-        nodes = [cls(left=nodes[0], right=nodes[1])] + nodes[2:]
-      return nodes[0]
+      # Leaves keep their order and merged nodes go before every node of the
+      # same probability, newest first, so the tree is the one a stable sort
+      # after each merge would give.
+      nodes = [(probability, i, cls(label, probability)) for (i, (label, probability)) in enumerate(weights.items())]
+      heapq.heapify(nodes)
+      for order in range(-1, -len(nodes), -1):
+        (_, _, left) = heapq.heappop(nodes)
+        (_, _, right) = heapq.heappop(nodes)
+        node = cls(left=left, right=right)
+        heapq.heappush(nodes, (node.probability, order, node))
+      return nodes[0][2]
 
   encoding = {}
   stack = [(Node.from_weights(sorted_weights), '')]
@@ -63,14 +105,57 @@ def create(weights: dict[str, float]) -> dict[str, float]:
       if node.left: stack.append((node.left, f'{key}0'))
       if node.right: stack.append((node.right, f'{key}1'))
 
-  return ':'.join(map(''.join, encoding.items()))
+  return encoding
+
+def calculate_length_loss(weights: dict[str, float], max_length: int) -> float:
+  # Share of the average length of the unconstrained Huffman code which a code
+  # limited to `max_length` bits takes on top of it.
+  unlimited = calculate_average_length(weights, create_codewords(weights))
+  return calculate_average_length(weights, create_codewords(weights, max_length)) / unlimited - 1
+
+def code_stats(table_bytes: int, weights: dict[str, float], max_length: int = None) -> dict:
+  stats = {'table_symbols': len(weights), 'table_bytes': table_bytes}
+  if max_length is not None: stats['length_lost'] = calculate_length_loss(weights, max_length)
+  return stats
 
-def create_encoding(code: str) -> dict[str, str]:
+@instrument.timed('lab-5 create', argument=None, output=False, stats=lambda code, weights, max_length=None, **_: code_stats(len(code.encode()), weights, max_length))
+def create(weights: dict[str, float], *, max_length: int = None) -> str:
+  return ':'.join(map(''.join, create_codewords(weights, max_length).items()))
+
+@instrument.timed('lab-5 create_canonical', argument=None, output=False, stats=lambda code, weights, max_length=None, **_: {**code_stats(len(code), weights, max_length), 'max_code_length': code[1]})
+def create_canonical(weights: dict[str, float], *, max_length: int = None) -> bytes:
+  lengths = Counter(map(len, (codewords := create_codewords(weights, max_length)).values()))
+  max_len = max(lengths)
+  symbols = ''.join(sorted(codewords, key=lambda x: (len(codewords[x]), x)))
+
+  # Binary code is a zero byte, which never starts a text code, the longest
+  # code length, the number of codes of each length and the symbols ordered
+  # as in the canonical code.
+  return struct.pack(f'>BB{max_len + 1}I', 0, max_len, *map(lengths.get, range(max_len + 1), repeat(0))) \
+    + symbols.encode()
+
+def create_canonical_encoding(lengths: Iterable[tuple[str, int]]) -> dict[str, str]:
+  encoding = {}
+  (code, previous) = (0, 0)
+  for (symbol, length) in lengths:
+    code <<= length - previous
+    encoding[symbol] = f'{code:0{length}b}' if length else ''
+    (code, previous) = (code + 1, length)
+  return encoding
+
+def create_encoding(code: str | bytes) -> dict[str, str]:
+  if isinstance(code, bytes):
+    max_len = code[1]
+    counts = struct.unpack_from(f'>{max_len + 1}I', code, 2)
+    symbols = code[2 + 4 * (max_len + 1):].decode()
+    lengths = (length for (length, count) in enumerate(counts) for _ in range(count))
+    return create_canonical_encoding(zip(symbols, lengths))
   return dict(map(lambda x: (x[0], x[1:]), code.split(':')))
 
-def create_decoding(code: str) -> dict[str, str]:
+def create_decoding(code: str | bytes) -> dict[str, str]:
   return {v: k for (k, v) in create_encoding(code).items()}
 
+@instrument.timed('lab-5 encode')
 def encode(text: str, encoding: dict[str, str]):
   encoded = bitarray(''.join(map(encoding.get, text)))
 
@@ -83,6 +168,7 @@ def encode(text: str, encoding: dict[str, str]):
 
   return encoded
 
+@instrument.timed('lab-5 decode')
 def decode(encoded: bitarray, decoding: dict[str, str]):
   min_code_len = min(map(len, decoding))
 
@@ -100,17 +186,645 @@ def decode(encoded: bitarray, decoding: dict[str, str]):
 
   return decoded
 
-def save(encoded: bitarray, code: str, name: str):
+@instrument.timed('lab-5 create_decoding_table', argument=None, output=False, stats=lambda table, *_: {'table_states': len(table[0]), 'table_entries': len(table[1])})
+def create_decoding_table(decoding: dict[str, str]) -> tuple[list[str], list[tuple[str, int]]]:
+  # Every proper prefix of a codeword is a state of the decoder, the empty
+  # prefix being the initial one. For each state and each possible byte the
+  # table holds all of the symbols completed within that byte and the offset
+  # of the state the byte leaves the decoder in, so a byte costs one probe.
+  prefixes = sorted({code[:i] for code in decoding for i in range(len(code))}, key=len)
+  states = {prefix: i * 256 for (i, prefix) in enumerate(prefixes)}
+
+  table = []
+  for prefix in prefixes:
+    for byte in range(256):
+      (code, symbols) = (prefix, [])
+      for bit in f'{byte:08b}':
+        code += bit
+        if code in decoding:
+          symbols.append(decoding[code])
+          code = ''
+      # Code of a single symbol is not complete, bits off it never show up.
+      table.append((''.join(symbols), states.get(code, 0)))
+
+  return prefixes, table
+
+@instrument.timed('lab-5 decode_table')
+def decode_table(
+  encoded: bitarray, decoding: dict[str, str], table: tuple[list[str], list[tuple[str, int]]] = None
+) -> str:
+  (prefixes, table) = table or create_decoding_table(decoding)
+  states = {prefix: i * 256 for (i, prefix) in enumerate(prefixes)}
+
+  def walk(code: str, bits: str, end: int = None):
+    symbols = []
+    for (position, bit) in enumerate(bits):
+      if end is not None and position >= end and not code: break
+      code += bit
+      if code in decoding:
+        symbols.append(decoding[code])
+        code = ''
+    return ''.join(symbols), code
+
+  # It's to prevent extra symbols from the overflow of the last byte.
+  position = 3
+  offset = int(encoded[:position].to01(), 2)
+  end = len(encoded) - offset
+
+  data = encoded.tobytes()
+  last = end // 8
+  decoded = [''] * (last + 1)
+  code = ''
+  if last:
+    (decoded[0], code) = walk(code, encoded[position:8].to01())
+    state = states[code]
+    for (i, byte) in enumerate(data[1:last], start=1):
+      (decoded[i], state) = table[state + byte]
+    code = prefixes[state // 256]
+    position = last * 8
+
+  # Symbols which start before the end are decoded until completed
+  # the same way as `decode` does it.
+  (decoded[-1], _) = walk(code, encoded[position:].to01(), end - position)
+
+  return ''.join(decoded)
+
+@instrument.timed('lab-5 save')
+def save(encoded: bitarray, code: str | bytes, name: str):
   with open(f"results/{name}.encoded", 'wb') as file:
     file.write(encoded.tobytes())
 
-  with open(f"results/{name}.code", 'w') as file:
+  with open(f"results/{name}.code", 'wb' if isinstance(code, bytes) else 'w') as file:
     file.write(code)
 
+@instrument.timed('lab-5 load', argument=None)
 def load(name: str):
   (encoded := bitarray()).frombytes(readfile(f'results/{name}.encoded', 'rb'))
-  code = readfile(f'results/{name}.code')
-  return encoded, code
+  code = readfile(f'results/{name}.code', 'rb')
+  return encoded, code if code.startswith(b'\0') else code.decode()
+
+def save_container(encoded: bitarray, code: str | bytes, name: str, length: int):
+  table = code if isinstance(code, bytes) else code.encode()
+  container.write(f'results/{name}.container', 'lab-5', length, table, encoded.tobytes())
+
+def decode_container(table: bytes, payload: bytes) -> str:
+  (encoded := bitarray()).frombytes(payload)
+  decoding = create_decoding(table if table.startswith(b'\0') else table.decode())
+  return decode_table(encoded, decoding)
+
+@instrument.timed('lab-5 encode_file', argument=None, stats=lambda result, *_, **__: {'bits': result[0], 'table_bytes': len(result[1])})
+def encode_file(filename: str, name: str, *, size: int = 2 ** 20):
+  with instrument.phase('lab-5 encode_file counting'):
+    frequencies = mapped.count_letters(mapped.mapletters(filename, size))
+  code = create_canonical(frequencies)
+  codes = mapped.create_mapped_codes(create_encoding(code))
+
+  with open(f"results/{name}.code", 'wb') as file:
+    file.write(code)
+
+  # Only whole bytes are written while encoding, the offset is not known
+  # until the end so its bits are filled in once everything is written.
+  length = 0
+  with instrument.phase('lab-5 encode_file encoding'), open(f"results/{name}.encoded", 'w+b') as file:
+    encoded = bitarray('000')
+    for chunk in mapped.mapletters(filename, size):
+      encoded.encode(codes, chunk)
+      whole = len(encoded) - len(encoded) % 8
+      file.write(encoded[:whole].tobytes())
+      del encoded[:whole]
+      length += whole
+    length += len(encoded)
+    file.write(encoded.tobytes())
+
+    offset = -length % 8
+    file.seek(0)
+    first = file.read(1)
+    if first:
+      file.seek(0)
+      file.write(bytes([first[0] | offset << 5]))
+
+  return length, code
+
+# Blocks are coded independently, each one carries its own 3 bit header and,
+# unless the code is shared, its own canonical code, so they can be decoded
+# in any order and on any core.
+def encode_block(text: str, code: bytes | None = None) -> tuple[bytes, bytes]:
+  if code is None: code = create_canonical(Counter(text))
+  codes = {letter: bitarray(bits) for (letter, bits) in create_encoding(code).items()}
+  (encoded := bitarray('000')).encode(codes, text)
+  offset = -len(encoded) % 8
+  encoded[:3] = bitarray(f'{offset:03b}')
+  return code, encoded.tobytes()
+
+def encode_blocks(
+  text: str, *, block: int = 2 ** 20, shared: bool = True, processes: int = None
+) -> list[tuple[bytes, bytes]]:
+  chunks = [text[start:start + block] for start in range(0, len(text), block)]
+  with ProcessPoolExecutor(processes) as executor:
+    # Shared code is built from the counts of the blocks, each one counted
+    # by a worker.
+    code = None
+    if shared:
+      weights = Counter()
+      for counts in executor.map(Counter, chunks): weights.update(counts)
+      code = create_canonical(weights)
+    return list(executor.map(encode_block, chunks, repeat(code)))
+
+def decode_blocks(blocks: list[tuple[bytes, bytes]], *, processes: int = None) -> str:
+  with ProcessPoolExecutor(processes) as executor:
+    return ''.join(executor.map(decode_container, *zip(*blocks)))
+
+# Adaptive (FGK) Huffman needs no code table, both sides update the same tree
+# after every symbol. Symbol seen for the first time is sent as the code of the
+# NYT (not yet transmitted) node followed by its utf-8 bytes and the stream ends
+# with the NYT code followed by 0xFF, which never starts a utf-8 character, so
+# nothing has to be known before the first byte is written.
+class AdaptiveTree(object):
+  def __init__(self):
+    # Nodes are kept in order of their numbers from the root down, so weights
+    # never grow along the lists and swapping two nodes swaps their contents.
+    self.weights = [0]
+    self.parents = [-1]
+    self.lefts = [-1]
+    self.rights = [-1]
+    self.symbols = [None]
+    self.leaves = {}
+    self.nyt = 0
+
+  def code(self, node: int) -> str:
+    bits = []
+    while (parent := self.parents[node]) != -1:
+      bits.append('1' if self.rights[parent] == node else '0')
+      node = parent
+    return ''.join(reversed(bits))
+
+  def swap(self, a: int, b: int):
+    (weights, lefts, rights, symbols) = (self.weights, self.lefts, self.rights, self.symbols)
+    (weights[a], weights[b]) = (weights[b], weights[a])
+    (lefts[a], lefts[b]) = (lefts[b], lefts[a])
+    (rights[a], rights[b]) = (rights[b], rights[a])
+    (symbols[a], symbols[b]) = (symbols[b], symbols[a])
+    for node in (a, b):
+      if lefts[node] != -1:
+        self.parents[lefts[node]] = self.parents[rights[node]] = node
+      else:
+        self.leaves[symbols[node]] = node
+    if self.nyt in (a, b): self.nyt = a if self.nyt == b else b
+
+  def update(self, symbol: str):
+    if (node := self.leaves.get(symbol)) is None:
+      nyt = self.nyt
+      (self.lefts[nyt], self.rights[nyt]) = (nyt + 2, nyt + 1)
+      self.weights += [0, 0]
+      self.parents += [nyt, nyt]
+      self.lefts += [-1, -1]
+      self.rights += [-1, -1]
+      self.symbols += [symbol, None]
+      self.leaves[symbol] = node = nyt + 1
+      self.nyt = nyt + 2
+
+    # Weights never rise along the numbering, so the leader of a block, its
+    # first node, is found by bisection instead of a walk over the block.
+    (weights, parents) = (self.weights, self.parents)
+    while node != -1:
+      weight = weights[node]
+      if node and weights[node - 1] == weight:
+        leader = bisect_left(weights, -weight, 0, node, key=operator.neg)
+        if leader == parents[node]:
+          # Sibling of NYT whose parent leads the block goes right after the
+          # parent and both are incremented, so weights keep falling.
+          if leader + 1 != node: self.swap(node, leader + 1)
+          weights[leader + 1] = weight + 1
+        else:
+          self.swap(node, leader)
+        node = leader
+      weights[node] = weight + 1
+      node = parents[node]
+
+def encode_adaptive_stream(chunks: Iterable[str]) -> Iterable[bytes]:
+  tree = AdaptiveTree()
+  encoded = bitarray()
+  for chunk in chunks:
+    codes = []
+    for symbol in chunk:
+      if symbol in tree.leaves:
+        codes.append(tree.code(tree.leaves[symbol]))
+      else:
+        codes.append(tree.code(tree.nyt) + ''.join(f'{byte:08b}' for byte in symbol.encode()))
+      tree.update(symbol)
+    encoded.extend(''.join(codes))
+    whole = len(encoded) - len(encoded) % 8
+    yield encoded[:whole].tobytes()
+    del encoded[:whole]
+
+  encoded.extend(tree.code(tree.nyt) + '11111111')
+  yield encoded.tobytes()
+
+def decode_adaptive_stream(chunks: Iterable[bytes]) -> Iterable[str]:
+  tree = AdaptiveTree()
+  (lefts, rights) = (tree.lefts, tree.rights)
+  chunks = iter(chunks)
+  # Bits are walked through a list of ints refilled from the chunks, a symbol
+  # takes at most as many bits as there are nodes and 4 bytes more.
+  (pending, bits, position) = (bitarray(), [], 0)
+
+  decoded = []
+  while True:
+    if len(bits) - position < len(lefts) + 32:
+      while len(pending) < 2 ** 16 and (chunk := next(chunks, None)) is not None: pending.frombytes(chunk)
+      (bits, position) = (bits[position:] + pending[:2 ** 16].tolist(), 0)
+      del pending[:2 ** 16]
+
+    node = 0
+    while lefts[node] != -1:
+      node = rights[node] if bits[position] else lefts[node]
+      position += 1
+
+    if node == tree.nyt:
+      if (first := bitarray(bits[position:position + 8]).tobytes()[0]) == 0xFF: break
+      length = 1 if first < 0x80 else 2 if first < 0xE0 else 3 if first < 0xF0 else 4
+      symbol = bitarray(bits[position:position + 8 * length]).tobytes().decode()
+      position += 8 * length
+    else:
+      symbol = tree.symbols[node]
+    tree.update(symbol)
+
+    decoded.append(symbol)
+    if len(decoded) >= 2 ** 16:
+      yield ''.join(decoded)
+      decoded = []
+  yield ''.join(decoded)
+
+@instrument.timed('lab-5 encode_adaptive')
+def encode_adaptive(text: str) -> bitarray:
+  (encoded := bitarray()).frombytes(b''.join(encode_adaptive_stream([text])))
+  return encoded
+
+@instrument.timed('lab-5 decode_adaptive')
+def decode_adaptive(encoded: bitarray) -> str:
+  return ''.join(decode_adaptive_stream([encoded.tobytes()]))
+
+# Range coder over 32 bit range with carry propagation, frequencies of a single
+# step have to total less than 2 ** 16 so that the range never becomes empty.
+class RangeEncoder(object):
+  def __init__(self):
+    self.low = 0
+    self.range = 0xFFFFFFFF
+    self.cache = 0
+    self.pending = 0
+    self.output = bytearray()
+
+  def shift(self):
+    if self.low < 0xFF000000 or self.low >= 1 << 32:
+      carry = self.low >> 32
+      self.output.append((self.cache + carry) & 0xFF)
+      self.output.extend(repeat((0xFF + carry) & 0xFF, self.pending))
+      self.pending = 0
+      self.cache = (self.low >> 24) & 0xFF
+    else:
+      self.pending += 1
+    self.low = (self.low << 8) & 0xFFFFFFFF
+
+  def encode(self, start: int, size: int, total: int):
+    step = self.range // total
+    self.low += start * step
+    self.range = size * step
+    while self.range < 1 << 24:
+      self.range <<= 8
+      self.shift()
+
+  def finish(self) -> bytes:
+    for _ in range(5): self.shift()
+    return bytes(self.output)
+
+class RangeDecoder(object):
+  def __init__(self, encoded: bytes):
+    self.encoded = encoded
+    self.position = 5
+    self.range = 0xFFFFFFFF
+    self.code = int.from_bytes(encoded[:5].ljust(5, b'\0'), 'big')
+
+  def decode(self, total: int) -> int:
+    self.step = self.range // total
+    return min(self.code // self.step, total - 1)
+
+  def update(self, start: int, size: int):
+    self.code -= start * self.step
+    self.range = size * self.step
+    while self.range < 1 << 24:
+      byte = self.encoded[self.position] if self.position < len(self.encoded) else 0
+      self.code = (self.code << 8) | byte
+      self.range <<= 8
+      self.position += 1
+
+# Context model mixes every order from `degree` down to 0 the way PPM does it:
+# a context which has not seen the symbol codes an escape (weighted by number
+# of distinct symbols in it) and symbols already ruled out by the longer
+# contexts are excluded. Below order 0 symbols are sent as uniform utf-8 bytes
+# and code 256 marks the end of the text.
+class ContextModel(object):
+  limit = 2 ** 14
+
+  def __init__(self, degree: int):
+    self.degree = degree
+    self.contexts: dict[str, dict[str, int]] = {}
+    self.totals: dict[str, int] = {}
+
+  def orders(self, history: str) -> Iterable[str]:
+    for order in range(min(self.degree, len(history)), -1, -1):
+      yield history[len(history) - order:]
+
+  def update(self, history: str, symbol: str):
+    for context in self.orders(history):
+      counts = self.contexts.setdefault(context, {})
+      counts[symbol] = counts.get(symbol, 0) + 1
+      self.totals[context] = self.totals.get(context, 0) + 1
+      if self.totals[context] > self.limit:
+        for key in counts: counts[key] = (counts[key] + 1) // 2
+        self.totals[context] = sum(counts.values())
+
+@instrument.timed('lab-5 encode_context')
+def encode_context(text: str, degree: int = 4) -> bytes:
+  model = ContextModel(degree)
+  coder = RangeEncoder()
+
+  def escape(history: str, symbol: str | None) -> bool:
+    excluded = set()
+    for context in model.orders(history):
+      counts = model.contexts.get(context, {})
+      start = total = 0
+      for (key, count) in counts.items():
+        if key in excluded: continue
+        if key == symbol: start = total
+        total += count
+      distinct = len(counts) - len(excluded & counts.keys())
+      if not distinct: continue
+      if symbol in counts:
+        coder.encode(start, counts[symbol], total + distinct)
+        return False
+      coder.encode(total, distinct, total + distinct)
+      excluded.update(counts)
+    return True
+
+  for (position, symbol) in enumerate(text):
+    history = text[max(0, position - degree):position]
+    if escape(history, symbol):
+      for byte in symbol.encode(): coder.encode(byte, 1, 257)
+    model.update(history, symbol)
+
+  escape(text[max(0, len(text) - degree):], None)
+  coder.encode(256, 1, 257)
+  return bytes([degree]) + coder.finish()
+
+@instrument.timed('lab-5 decode_context')
+def decode_context(encoded: bytes) -> str:
+  degree = encoded[0]
+  model = ContextModel(degree)
+  coder = RangeDecoder(encoded[1:])
+
+  def symbol(history: str) -> str | None:
+    excluded = set()
+    for context in model.orders(history):
+      counts = model.contexts.get(context, {})
+      available = [(key, count) for (key, count) in counts.items() if key not in excluded]
+      if not available: continue
+      total = sum(count for (_, count) in available)
+      target = coder.decode(total + len(available))
+      if target >= total:
+        coder.update(total, len(available))
+        excluded.update(counts)
+        continue
+      start = 0
+      for (key, count) in available:
+        if target < start + count:
+          coder.update(start, count)
+          return key
+        start += count
+
+    lead = coder.decode(257)
+    coder.update(lead, 1)
+    if lead == 256: return None
+    length = 1 if lead < 0x80 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+    rest = []
+    for _ in range(length - 1):
+      rest.append(byte := coder.decode(257))
+      coder.update(byte, 1)
+    return bytes([lead, *rest]).decode()
+
+  decoded = []
+  history = ''
+  while (letter := symbol(history)) is not None:
+    model.update(history, letter)
+    decoded.append(letter)
+    history = (history + letter)[-degree:] if degree else ''
+  return ''.join(decoded)
+
+# region [[Block sorting]]
+def sort_suffixes(symbols: list[int], upper: int) -> list[int]:
+  # SA-IS: suffixes are typed S or L by comparing with the next one, the
+  # leftmost S suffixes of each run (LMS) are placed into their buckets and
+  # the other ones are induced from them. If LMS substrings are not unique
+  # they are named and sorted by the same procedure recursively.
+  n = len(symbols)
+  if n < 3: return sorted(range(n), key=lambda i: symbols[i:])
+
+  smaller = [False] * n
+  for i in range(n - 2, -1, -1):
+    smaller[i] = smaller[i + 1] if symbols[i] == symbols[i + 1] else symbols[i] < symbols[i + 1]
+
+  (starts, ends) = ([0] * (upper + 2), [0] * (upper + 2))
+  for (symbol, is_smaller) in zip(symbols, smaller):
+    if is_smaller: starts[symbol + 1] += 1
+    else: ends[symbol] += 1
+  for i in range(upper + 1):
+    ends[i] += starts[i]
+    starts[i + 1] += ends[i]
+
+  suffixes = [-1] * n
+  def induce(lms: list[int]):
+    suffixes[:] = [-1] * n
+    buckets = ends[:]
+    for i in lms:
+      suffixes[buckets[symbols[i]]] = i
+      buckets[symbols[i]] += 1
+    buckets = starts[:]
+    suffixes[buckets[symbols[-1]]] = n - 1
+    buckets[symbols[-1]] += 1
+    for i in range(n):
+      if (j := suffixes[i] - 1) >= 0 and not smaller[j]:
+        suffixes[buckets[symbols[j]]] = j
+        buckets[symbols[j]] += 1
+    buckets = starts[:]
+    for i in range(n - 1, -1, -1):
+      if (j := suffixes[i] - 1) >= 0 and smaller[j]:
+        buckets[symbols[j] + 1] -= 1
+        suffixes[buckets[symbols[j] + 1]] = j
+
+  lms = [i for i in range(1, n) if not smaller[i - 1] and smaller[i]]
+  names = [-1] * n
+  for (name, i) in enumerate(lms): names[i] = name
+  induce(lms)
+
+  if lms:
+    ordered = [i for i in suffixes if names[i] >= 0]
+    reduced = [0] * len(lms)
+    name = 0
+    for (left, right) in zip(ordered, ordered[1:]):
+      left_end = lms[names[left] + 1] if names[left] + 1 < len(lms) else n
+      right_end = lms[names[right] + 1] if names[right] + 1 < len(lms) else n
+      if left_end - left != right_end - right or symbols[left:left_end + 1] != symbols[right:right_end + 1]:
+        name += 1
+      reduced[names[right]] = name
+    induce([lms[i] for i in sort_suffixes(reduced, name)])
+
+  return suffixes
+
+@instrument.timed('lab-5 create_suffix_array', output=False)
+def create_suffix_array(text: str | bytes) -> list[int]:
+  symbols = list(map(ord, text)) if isinstance(text, str) else list(text)
+  return sort_suffixes(symbols, max(symbols, default=0))
+
+def create_lcp_array(text: str | bytes, suffixes: list[int]) -> list[int]:
+  # Kasai: the common prefix of a suffix with the one sorted before it is at
+  # most one shorter than the one of the suffix starting a position earlier.
+  ranks = [0] * len(suffixes)
+  for (rank, i) in enumerate(suffixes): ranks[i] = rank
+  lcp = [0] * len(suffixes)
+  common = 0
+  for i in range(len(text)):
+    if ranks[i] == 0:
+      common = 0
+      continue
+    j = suffixes[ranks[i] - 1]
+    while i + common < len(text) and j + common < len(text) and text[i + common] == text[j + common]: common += 1
+    lcp[ranks[i]] = common
+    common = max(common - 1, 0)
+  return lcp
+
+def find_occurrences(text: str | bytes, suffixes: list[int], pattern: str | bytes) -> list[int]:
+  start = bisect_left(suffixes, pattern, key=lambda i: text[i:i + len(pattern)])
+  end = bisect_right(suffixes, pattern, lo=start, key=lambda i: text[i:i + len(pattern)])
+  return sorted(suffixes[start:end])
+
+def ngrams_from_suffix_array(text: str | bytes, suffixes: list[int], lcp: list[int], n: int) -> dict:
+  # Suffixes starting with the same n-gram are next to each other and share
+  # at least n first symbols with the previous one.
+  ngrams = {}
+  for (rank, i) in enumerate(suffixes):
+    if i + n > len(text): continue
+    if rank and lcp[rank] >= n: ngrams[ngram] += 1
+    else: ngrams[ngram := text[i:i + n]] = 1
+  return ngrams
+
+# Block is sorted with the end of text as the smallest symbol, the last column
+# of sorted rotations is written without it and with the row it was in.
+# Move-to-front turns the runs of the last column into zeros and runs of
+# zeros are written in bijective base 2 with RUNA and RUNB, the other ranks
+# moved up by one, before a Huffman code is made for the block.
+RUNA = 0
+RUNB = 1
+bwt_header = struct.Struct('>III')
+
+def transform_block(block: bytes) -> tuple[bytes, int]:
+  suffixes = create_suffix_array(block)
+  last = bytearray([block[-1]]) if block else bytearray()
+  last += bytes(block[i - 1] for i in suffixes if i)
+  return bytes(last), 1 + suffixes.index(0) if block else 0
+
+def inverse_block(last: bytes, primary: int) -> bytes:
+  # Rows are followed from the last column to the first one, every row is
+  # found as the rank of its symbol among the equal ones before it.
+  counts = [0] * 257
+  ranks = [0] * (len(last) + 1)
+  for (row, symbol) in enumerate(last[:primary] + b'\0' + last[primary:]):
+    if row == primary: continue
+    ranks[row] = counts[symbol]
+    counts[symbol] += 1
+  firsts = [1] * 257
+  for symbol in range(1, 257): firsts[symbol] = firsts[symbol - 1] + counts[symbol - 1]
+
+  decoded = bytearray(len(last))
+  row = 0
+  for position in range(len(last) - 1, -1, -1):
+    symbol = last[row - (row > primary)]
+    decoded[position] = symbol
+    row = firsts[symbol] + ranks[row]
+  return bytes(decoded)
+
+def move_to_front(data: bytes) -> list[int]:
+  order = list(range(256))
+  ranks = []
+  for symbol in data:
+    rank = order.index(symbol)
+    ranks.append(rank)
+    if rank:
+      del order[rank]
+      order.insert(0, symbol)
+  return ranks
+
+def move_to_back(ranks: Iterable[int]) -> bytes:
+  order = list(range(256))
+  data = bytearray()
+  for rank in ranks:
+    symbol = order[rank]
+    data.append(symbol)
+    if rank:
+      del order[rank]
+      order.insert(0, symbol)
+  return bytes(data)
+
+def encode_runs(ranks: list[int]) -> list[int]:
+  symbols = []
+  run = 0
+  for rank in ranks + [-1]:
+    if rank == 0:
+      run += 1
+      continue
+    while run:
+      symbols.append(RUNA if run & 1 else RUNB)
+      run = (run - 1) // 2
+    if rank > 0: symbols.append(rank + 1)
+  return symbols
+
+def decode_runs(symbols: Iterable[int]) -> list[int]:
+  ranks = []
+  (run, weight) = (0, 1)
+  for symbol in symbols:
+    if symbol <= RUNB:
+      run += weight << symbol
+      weight <<= 1
+      continue
+    ranks.extend(repeat(0, run))
+    (run, weight) = (0, 1)
+    ranks.append(symbol - 1)
+  ranks.extend(repeat(0, run))
+  return ranks
+
+@instrument.timed('lab-5 encode_bwt')
+def encode_bwt(text: str, *, block: int = 2 ** 18) -> bytes:
+  data = text.encode()
+  encoded = []
+  for start in range(0, len(data), block):
+    (last, primary) = transform_block(data[start:start + block])
+    symbols = ''.join(map(chr, encode_runs(move_to_front(last))))
+    (code, payload) = encode_block(symbols, create_canonical(Counter(symbols)))
+    encoded.append(bwt_header.pack(primary, len(code), len(payload)) + code + payload)
+  return b''.join(encoded)
+
+@instrument.timed('lab-5 decode_bwt')
+def decode_bwt(encoded: bytes) -> str:
+  decoded = []
+  position = 0
+  while position < len(encoded):
+    (primary, code_size, payload_size) = bwt_header.unpack_from(encoded, position)
+    position += bwt_header.size
+    code = encoded[position:position + code_size]
+    payload = encoded[position + code_size:position + code_size + payload_size]
+    position += code_size + payload_size
+    last = move_to_back(decode_runs(map(ord, decode_container(code, payload))))
+    decoded.append(inverse_block(last, primary))
+  return b''.join(decoded).decode()
+# endregion
 
 def verify():
   try:
@@ -141,16 +855,116 @@ if __name__ == '__main__':
   print(f"2. Huffman encoding.")
 
   weights = create_weights(original)
-  code = create(weights)
+  code = create_canonical(weights)
   encoding = create_encoding(code)
   average_length = calculate_average_length(weights, encoding)
   print(f"Average code length: {average_length:.2f} bits")
   print(f'Coding effectivity: {entropy / average_length * 100:.2f}%')
+  print(f"Code size: {len(code)} bytes (text code: {len(create(weights).encode())} bytes)")
 
   encoded = encode(original, encoding)
   filename = 'test'
   save(encoded, code, filename)
   encoded, code = load(filename)
-  decoded = decode(encoded, create_decoding(code))
+  decoding = create_decoding(code)
+  decoded = decode(encoded, decoding)
   print(f"Original text is: {original[:100]}...")
   print(f"Decoded text is:  {decoded[:100]}...")
+
+  save_container(encoded, code, filename, len(original))
+  assert container.decode(f'results/{filename}.container') == decode_table(encoded, decoding)
+
+  # File of a single letter gets a code too.
+  with open(f'results/{filename}_single.txt', 'w') as file: file.write('a' * 1000)
+  encode_file(f'results/{filename}_single.txt', f'{filename}_single')
+  (single, single_code) = load(f'{filename}_single')
+  assert decode_table(single, create_decoding(single_code)) == 'a' * 1000
+
+  print()
+  print("3. Table decoding.")
+  start = time.perf_counter()
+  table_decoded = decode_table(encoded, decoding, create_decoding_table(decoding))
+  elapsed = time.perf_counter() - start
+  assert decoded == table_decoded
+  print(f"Decoded text is:  {table_decoded[:100]}...")
+  print(f"Throughput: {len(table_decoded) / elapsed / 2 ** 20:.2f} MiB/s")
+
+  print()
+  print("4. Adaptive Huffman.")
+  start = time.perf_counter()
+  static = encode(original, create_encoding(create_canonical(create_weights(original))))
+  static_elapsed = time.perf_counter() - start
+  start = time.perf_counter()
+  adaptive = encode_adaptive(original)
+  adaptive_elapsed = time.perf_counter() - start
+  start = time.perf_counter()
+  adaptive_decoded = decode_adaptive(adaptive)
+  decode_elapsed = time.perf_counter() - start
+  assert adaptive_decoded == original
+  print(f"Static size: {math.ceil((3 + len(static)) / 8) + len(code)} bytes (with code), {len(original) / static_elapsed / 2 ** 20:.2f} MiB/s")
+  print(f"Adaptive size: {len(adaptive) // 8} bytes, {len(original) / adaptive_elapsed / 2 ** 20:.2f} MiB/s")
+  print(f"Adaptive decoding: {len(original) / decode_elapsed / 2 ** 20:.2f} MiB/s")
+
+  print()
+  print("5. Context modelling.")
+  huffman_size = len(readfile(f'results/{filename}.encoded', 'rb')) + len(readfile(f'results/{filename}.code', 'rb'))
+  print(f"Huffman size: {huffman_size} bytes ({huffman_size * 8 / len(original):.3f} bits per letter)")
+  conditional_entropies = container.open_lab('lab-3').count_conditional_entropies(original, 5, kind='letters')
+  for degree in range(6):
+    start = time.perf_counter()
+    context_encoded = encode_context(original, degree)
+    elapsed = time.perf_counter() - start
+    assert decode_context(context_encoded) == original
+    print(f"Order {degree}: {len(context_encoded)} bytes ({len(context_encoded) * 8 / len(original):.3f} bits per letter, conditional entropy {conditional_entropies[degree]:.3f}), {len(original) / elapsed / 2 ** 20:.2f} MiB/s")
+
+  with open(f"results/{filename}_context.encoded", 'wb') as file:
+    file.write(encode_context(original))
+
+  print()
+  print("6. Block-parallel coding.")
+  for processes in sorted({1, os.cpu_count()}):
+    for shared in (True, False):
+      start = time.perf_counter()
+      blocks = encode_blocks(original, block=2 ** 14, shared=shared, processes=processes)
+      encode_elapsed = time.perf_counter() - start
+      start = time.perf_counter()
+      assert decode_blocks(blocks, processes=processes) == original
+      decode_elapsed = time.perf_counter() - start
+      size = sum(len(code) * (not shared) + len(payload) for (code, payload) in blocks) + len(blocks[0][0]) * shared
+      print(f"{processes} processes, {'shared' if shared else 'own'} code: {size} bytes, encoding {len(original) / encode_elapsed / 2 ** 20:.2f} MiB/s, decoding {len(original) / decode_elapsed / 2 ** 20:.2f} MiB/s")
+
+  # Blocks of a single letter, as a run of spaces longer than a block.
+  single = ' ' * 2 ** 14 + 'a'
+  assert decode_blocks(encode_blocks(single, block=2 ** 12, shared=False, processes=1), processes=1) == single
+
+  print()
+  print("7. Length-limited Huffman.")
+  for max_length in (5, 6, 8, 12, 15):
+    if len(weights) > 2 ** max_length: continue
+    limited_code = create_canonical(weights, max_length=max_length)
+    limited_length = calculate_average_length(weights, create_encoding(limited_code))
+    limited_decoding = create_decoding(limited_code)
+    (limited_encoded := bitarray()).frombytes(encode(original, create_encoding(limited_code)).tobytes())
+    table = create_decoding_table(limited_decoding)
+    start = time.perf_counter()
+    assert decode_table(limited_encoded, limited_decoding, table) == original
+    elapsed = time.perf_counter() - start
+    print(f"Max {max_length} bits: {limited_length:.4f} bits per letter ({calculate_length_loss(weights, max_length) * 100:.2f}% lost), {len(table[1])} table entries, table decoding {len(original) / elapsed / 2 ** 20:.2f} MiB/s")
+
+  print()
+  print("8. Block sorting.")
+  context_size = len(readfile(f"results/{filename}_context.encoded", 'rb'))
+  print(f"Huffman size: {huffman_size} bytes, order 4 context size: {context_size} bytes")
+  for block in (2 ** 12, 2 ** 16, 2 ** 20):
+    start = time.perf_counter()
+    bwt_encoded = encode_bwt(original, block=block)
+    encode_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    assert decode_bwt(bwt_encoded) == original
+    decode_elapsed = time.perf_counter() - start
+    print(f"Block {block}: {len(bwt_encoded)} bytes ({len(bwt_encoded) * 8 / len(original):.3f} bits per letter), encoding {len(original) / encode_elapsed / 2 ** 20:.2f} MiB/s, decoding {len(original) / decode_elapsed / 2 ** 20:.2f} MiB/s")
+
+  suffixes = create_suffix_array(original)
+  lcp = create_lcp_array(original, suffixes)
+  print(f"Occurrences of 'the ': {len(find_occurrences(original, suffixes, 'the '))}")
+  print(f"Most common 5-grams: {Counter(ngrams_from_suffix_array(original, suffixes, lcp, 5)).most_common(5)}")
@@ -1,15 +1,32 @@
-from itertools import pairwise, islice, takewhile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import pairwise, islice, repeat, takewhile
 import os
+import struct
+import sys
+import time
+import tracemalloc
 from typing import Literal, Iterable
 from bitarray import bitarray
-from math import log2, ceil
+import numpy as np
+from math import log2, ceil, inf
 from operator import itemgetter
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import container
+import instrument
+import mapped
+
 # region [[Utilities]]
 def readfile(filename: str, mode: Literal['r', 'rb', 'r+b'] = 'rb') -> str:
   with open(filename, mode) as file:
     return file.read()
 
+def readchunks(filename: str, size: int = 2 ** 20) -> Iterable[bytes]:
+  with open(filename, 'rb') as file:
+    while chunk := file.read(size):
+      yield chunk
+
 def format_size(size: int):
   sizes = ['b', 'Kib', 'Mib', 'Gib', 'Tib', 'Pib', 'Eib', 'Zib', 'Yib']
   i = 0
@@ -29,6 +46,22 @@ def safeconcat(a, b):
   return (*a, *b)
 # endregion
 
+# Every code but the last one is written on a dictionary miss, so hits and
+# dictionary growth follow from the number of codes.
+def encoding_stats(result: tuple[bitarray, str], text: bytes, max_size: int = None) -> dict:
+  (encoded, code) = result
+  (code_len, *alphabet) = code.split(':')
+  codes = (len(encoded) - 3) // int(code_len)
+  added = codes - 1 if max_size is None else min(codes - 1, max(max_size - len(alphabet), 0))
+  return {
+    'codes': codes,
+    'code_bits': int(code_len),
+    'hit_rate': (len(text) - codes) / max(len(text) - 1, 1),
+    'dictionary_size': len(alphabet) + added,
+    'dictionary_growth': added / len(text),
+  }
+
+@instrument.timed('lab-6 encode', stats=encoding_stats)
 def encode(text: str, max_size: int = None) -> tuple[bitarray, dict[int, str]]:
   def encode(text: list[int], encoding: dict[int, str]):
     encoded = bitarray(''.join(map(encoding.get, text)))
@@ -44,26 +77,36 @@ def encode(text: str, max_size: int = None) -> tuple[bitarray, dict[int, str]]:
   encoded = []
   encoded_chars = dict(map(reversed, enumerate(set(text))))
 
-  [current, *rest] = text
+  # A phrase is keyed by the code of its prefix and its last character packed
+  # into a single integer, so each step costs the same no matter how long the
+  # phrase gets.
+  count = len(encoded_chars)
+  size = count
+  phrases = {}
+
+  rest = map(encoded_chars.get, text)
+  [current] = islice(rest, 1)
   for next in rest:
-    combined = safeconcat(current, next)
-    if combined in encoded_chars:
-      current = combined
+    combined = current * count + next
+    if combined in phrases:
+      current = phrases[combined]
       continue
 
-    if max_size is None or not len(encoded_chars) >= max_size:
-      encoded_chars[combined] = len(encoded_chars)
+    if max_size is None or not size >= max_size:
+      phrases[combined] = size
+      size += 1
 
-    encoded.append(encoded_chars[current])
+    encoded.append(current)
     current = next
-  encoded.append(encoded_chars[current])
+  encoded.append(current)
 
-  code_len = ceil(log2(len(encoded_chars)))
-  encoding = {n: f'{n:0{code_len}b}' for n in encoded_chars.values()}
+  code_len = ceil(log2(size))
+  encoding = {n: f'{n:0{code_len}b}' for n in range(size)}
   code = f"{code_len}:{':'.join(map(str, set(text)))}"
 
   return encode(encoded, encoding), code
 
+@instrument.timed('lab-6 decode')
 def decode(encoded: bitarray, decoding: dict[int | Literal['bits'], int]):
   text_len = len(encoded)
   code_len = decoding['bits']
@@ -91,6 +134,54 @@ def decode(encoded: bitarray, decoding: dict[int | Literal['bits'], int]):
 
   return bytes(result)
 
+@instrument.timed('lab-6 decode_array')
+def decode_array(encoded: bitarray, decoding: dict[int | Literal['bits'], int]) -> bytes:
+  code_len = decoding['bits']
+  count = len(decoding) - 1
+  capacity = 2 ** code_len
+
+  # Every code is read at once from the word starting at its first byte, the
+  # words overlap so they are a strided view of the bytes.
+  text_len = (len(encoded) - 3) // code_len
+  if not text_len: return b''
+  (raw, width) = (encoded.tobytes() + bytes(8), 4 if code_len <= 25 else 8)
+  words = np.ndarray((len(raw) - 7,), dtype=f'>u{width}', buffer=raw, strides=(1,))
+  starts = 3 + np.arange(text_len, dtype=np.int64) * code_len
+  shifts = (8 * width - code_len - (starts & 7)).astype(words.dtype)
+  codes = ((words[starts >> 3] >> shifts) & (capacity - 1)).astype(np.int64)
+
+  # Entry `count + k` is the phrase of the k-th code followed by the first
+  # byte of the next one, so every phrase but a single byte extends the phrase
+  # of an earlier code, its parent. Lengths and roots, the single bytes the
+  # phrases start with, are found by pointer jumping along the parents.
+  parents = np.where(codes >= count, codes - count, text_len)
+  (links, roots) = (np.append(parents, text_len), np.arange(text_len + 1))
+  lengths = np.append(np.ones(text_len, dtype=np.int64), 0)
+  while (links < text_len).any():
+    roots = np.where(links < text_len, roots[links], roots)
+    lengths += lengths[links]
+    links = links[links]
+  (lengths, roots) = (lengths[:text_len], roots[:text_len])
+
+  alphabet = np.frombuffer(bytes(decoding[i] for i in range(count)), dtype=np.uint8)
+  firsts = alphabet[codes[roots]]
+  lasts = np.where(codes < count, alphabet[np.minimum(codes, count - 1)], firsts[np.clip(codes - count + 1, 0, text_len - 1)])
+
+  # A phrase is its parent's phrase followed by its last byte, so the result
+  # is written from the end of every phrase backwards, a byte of each phrase
+  # still that long at a time. Longest phrases go first to keep them a prefix.
+  longest = int(lengths.max())
+  order = np.argsort((longest - lengths).astype(np.min_scalar_type(longest)), kind='stable')
+  ends = np.cumsum(lengths)
+  (tails, current) = (ends[order] - 1, order)
+  result = np.empty(int(ends[-1]), dtype=np.uint8)
+  for (back, size) in enumerate(np.cumsum(np.bincount(lengths)[:0:-1])[::-1].tolist()):
+    current = current[:size]
+    result[tails[:size] - back] = lasts[current]
+    current = parents[current]
+  return result.tobytes()
+
+@instrument.timed('lab-6 save', argument=1)
 def save(name: str, encoded: bitarray, code: str):
   os.makedirs(os.path.dirname(f'results/{name}'), exist_ok=True)
 
@@ -101,6 +192,7 @@ def save(name: str, encoded: bitarray, code: str):
     (code_len, *codes) = map(int, code.split(":"))
     file.write(bytes([code_len, *codes]))
 
+@instrument.timed('lab-6 load', argument=None)
 def load(name: str) -> tuple[bitarray, str]:
   # Remove overflow bits.
   (encoded := bitarray()).frombytes(readfile(f"results/{name}.encoded", 'rb'))
@@ -111,12 +203,280 @@ def load(name: str) -> tuple[bitarray, str]:
 
   return encoded, code
 
+def save_container(name: str, encoded: bitarray, code: str, length: int):
+  os.makedirs(os.path.dirname(f'results/{name}'), exist_ok=True)
+  (code_len, *codes) = map(int, code.split(":"))
+  container.write(f'results/{name}.container', 'lab-6', length, bytes([code_len, *codes]), encoded.tobytes())
+
+def decode_container(table: bytes, payload: bytes) -> bytes:
+  (encoded := bitarray()).frombytes(payload)
+  for _ in range(to_int(encoded[:3])): encoded.pop()
+  (code_len, *codes) = table
+  return decode_array(encoded, create_decoding(f"{code_len}:{':'.join(map(str, codes))}"))
+
 def create_decoding(code: str) -> dict[int | Literal['bits'], int]:
   (code_len, *codes) = map(int, code.split(':'))
   decoding = dict(enumerate(codes))
   decoding['bits'] = code_len
   return decoding
 
+# Blocks are coded independently with their own alphabet and dictionary, so
+# they can be encoded and decoded on separate cores and joined in order.
+def encode_block(text: bytes, max_size: int = None) -> tuple[bytes, bytes]:
+  (encoded, code) = encode(text, max_size)
+  (code_len, *codes) = map(int, code.split(":"))
+  return bytes([code_len, *codes]), encoded.tobytes()
+
+def encode_blocks(
+  text: bytes, max_size: int = None, *, block: int = 2 ** 20, processes: int = None
+) -> list[tuple[bytes, bytes]]:
+  chunks = [text[start:start + block] for start in range(0, len(text), block)]
+  with ProcessPoolExecutor(processes) as executor:
+    return list(executor.map(encode_block, chunks, repeat(max_size)))
+
+def decode_blocks(blocks: list[tuple[bytes, bytes]], *, processes: int = None) -> bytes:
+  with ProcessPoolExecutor(processes) as executor:
+    return b''.join(executor.map(decode_container, *zip(*blocks)))
+
+# region [[Streaming]]
+# Stream starts with a single byte holding the maximal code width (0 when the
+# dictionary is unlimited). Codes 0-255 are bytes and 256 resets the dictionary,
+# every other code is a phrase. Codes start at 9 bits and widen by a bit as soon
+# as the decoder may receive a code which does not fit.
+CLEAR = 256
+
+def code_width(size: int, max_size: int | None) -> int:
+  return max(9, (size if max_size is None else min(size, max_size - 1)).bit_length())
+
+def encode_stream(
+  chunks: Iterable[bytes], max_bits: int | None = 16, *, clear: bool = True, check: int = 2 ** 13
+) -> Iterable[bytes]:
+  if max_bits is not None and not 9 <= max_bits <= 255:
+    raise ValueError(f"Maximal code width has to be between 9 and 255 bits, got {max_bits}.")
+  max_size = 2 ** max_bits if max_bits else None
+  yield bytes([max_bits or 0])
+
+  phrases = {}
+  size = CLEAR + 1
+  encoded = bitarray()
+  # Compression ratio is checked at the first code written after every
+  # `check` bytes once the dictionary fills up, as soon as it gets worse than
+  # at the previous check the dictionary is cleared. `read` counts the bytes
+  # before the current chunk.
+  (read, written, ratio, checkpoint) = (0, 0, 0, check)
+  checked = clear and max_size is not None
+
+  current = None
+  for chunk in chunks:
+    codes = []
+    for (index, next) in enumerate(chunk):
+      if current is None:
+        current = next
+        continue
+
+      combined = current * 256 + next
+      if combined in phrases:
+        current = phrases[combined]
+        continue
+
+      width = code_width(size - 1, max_size)
+      codes.append(f'{current:0{width}b}')
+      written += width
+
+      if max_size is None or size < max_size:
+        phrases[combined] = size
+        size += 1
+      current = next
+
+      if checked and size >= max_size and read + index >= checkpoint:
+        checkpoint = read + index + check
+        if (read + index) * 8 / written >= ratio:
+          ratio = (read + index) * 8 / written
+        else:
+          codes.append(f'{CLEAR:0{width}b}')
+          phrases = {}
+          size = CLEAR + 1
+          (read, written, ratio, checkpoint) = (-index, 0, 0, check)
+
+    read += len(chunk)
+    encoded.extend(''.join(codes))
+    whole = len(encoded) - len(encoded) % 8
+    yield encoded[:whole].tobytes()
+    del encoded[:whole]
+
+  if current is not None:
+    encoded.extend(f'{current:0{code_width(size - 1, max_size)}b}')
+  yield encoded.tobytes()
+
+def decode_stream(chunks: Iterable[bytes]) -> Iterable[bytes]:
+  max_size = 0
+  table = [bytes([i]) for i in range(CLEAR)] + [b'']
+  previous = None
+
+  # Bits are gathered in an integer, codes are at least 9 bits wide so every
+  # byte completes at most one of them. Extra bits of the last byte are fewer
+  # than the shortest code. Width is only looked at again once the table
+  # grows to `grow` entries.
+  (value, count, width, grow) = (0, 0, 9, 2 ** 9)
+  for chunk in chunks:
+    if max_size == 0 and chunk:
+      max_size = 2 ** chunk[0] if chunk[0] else None
+      chunk = chunk[1:]
+
+    decoded = bytearray()
+    for byte in chunk:
+      (value, count) = (value << 8 | byte, count + 8)
+      if count < width: continue
+      count -= width
+      code = value >> count
+      value &= (1 << count) - 1
+
+      if code == CLEAR:
+        del table[CLEAR + 1:]
+        previous = None
+        (width, grow) = (9, 2 ** 9)
+      elif previous is None:
+        previous = table[code]
+        decoded += previous
+      else:
+        entry = table[code] if code < len(table) else previous + previous[:1]
+        if max_size is None or len(table) < max_size: table.append(previous + entry[:1])
+        decoded += entry
+        previous = entry
+      if len(table) >= grow:
+        width = code_width(len(table), max_size)
+        grow = 2 ** width if max_size is None or 2 ** width < max_size else inf
+
+    yield bytes(decoded)
+# endregion
+
+# region [[LZSS]]
+# Text is split into literals and back references of at least `MIN_MATCH`
+# bytes into the last `window` bytes. Literals and match lengths share one
+# alphabet, bytes are 0-255 and a match of length l is 256 + l - MIN_MATCH,
+# written as 9 bit numbers or with a lab-5 Huffman code. Distances of the
+# matches follow in a separate stream of fixed width.
+MIN_MATCH = 3
+MAX_MATCH = MIN_MATCH + 255
+lzss_header = struct.Struct('>BBII')
+
+def create_tokens(
+  text: bytes, window: int, *, chain: int = 64, lazy: bool = True
+) -> tuple[array, array]:
+  # Positions are chained by their first `MIN_MATCH` bytes, the newest first.
+  # A position is linked to the previous one with the same bytes in a ring
+  # of `window` entries, so links older than the window are overwritten.
+  head = {}
+  previous = array('q', [-1]) * window
+
+  def key(position: int) -> int:
+    return text[position] << 16 | text[position + 1] << 8 | text[position + 2]
+
+  def insert(position: int):
+    if position + MIN_MATCH <= len(text):
+      previous[position % window] = head.get(k := key(position), -1)
+      head[k] = position
+
+  def longest(position: int) -> tuple[int, int]:
+    limit = min(MAX_MATCH, len(text) - position)
+    if limit < MIN_MATCH: return 0, 0
+    (best, distance) = (0, 0)
+    candidate = head.get(key(position), -1)
+    for _ in range(chain):
+      if candidate < 0 or position - candidate > window: break
+      if best < MIN_MATCH or text[candidate + best] == text[position + best]:
+        # Chained positions share the first bytes, the rest of the match
+        # is found by comparing halves of the remaining slices.
+        (low, high) = (MIN_MATCH, limit)
+        while low < high:
+          middle = (low + high + 1) // 2
+          if text[candidate:candidate + middle] == text[position:position + middle]: low = middle
+          else: high = middle - 1
+        if low > best:
+          (best, distance) = (low, position - candidate)
+          if best == limit: break
+      candidate = previous[candidate % window]
+    return best, distance
+
+  (symbols, distances) = (array('H'), array('L'))
+  position = 0
+  while position < len(text):
+    (length, distance) = longest(position)
+    inserted = False
+    # Lazy matching gives up the match for a literal when the next position
+    # starts a longer one.
+    if lazy and MIN_MATCH <= length < MAX_MATCH:
+      insert(position)
+      (next_length, next_distance) = longest(position + 1)
+      if next_length > length:
+        symbols.append(text[position])
+        position += 1
+        (length, distance) = (next_length, next_distance)
+      else:
+        inserted = True
+
+    if length >= MIN_MATCH:
+      symbols.append(256 + length - MIN_MATCH)
+      distances.append(distance - 1)
+      for skipped in range(position + inserted, position + length): insert(skipped)
+      position += length
+    else:
+      symbols.append(text[position])
+      if not inserted: insert(position)
+      position += 1
+
+  return symbols, distances
+
+def encode_lzss(
+  text: bytes, window: int = 2 ** 12, *, huffman: bool = False, chain: int = 64, lazy: bool = True
+) -> bytes:
+  if window < 2: raise ValueError(f"Window has to hold at least 2 bytes, got {window}.")
+  window_bits = (window - 1).bit_length()
+  (symbols, distances) = create_tokens(text, window, chain=chain, lazy=lazy)
+
+  # A Huffman code needs at least two symbols.
+  huffman = huffman and len(set(symbols)) > 1
+  if huffman:
+    (code, payload) = container.open_lab('lab-5').encode_block(''.join(map(chr, symbols)))
+    section = struct.pack('>I', len(code)) + code + payload
+  else:
+    section = bitarray(''.join(f'{symbol:09b}' for symbol in symbols)).tobytes()
+
+  stream = bitarray(''.join(f'{distance:0{window_bits}b}' for distance in distances)).tobytes()
+  return lzss_header.pack(huffman, window_bits, len(symbols), len(section)) + section + stream
+
+def decode_lzss(encoded: bytes) -> bytes:
+  (huffman, window_bits, count, size) = lzss_header.unpack_from(encoded)
+  section = encoded[lzss_header.size:lzss_header.size + size]
+  if huffman:
+    (code_size,) = struct.unpack_from('>I', section)
+    letters = container.open_lab('lab-5').decode_container(section[4:4 + code_size], section[4 + code_size:])
+    symbols = map(ord, letters)
+  else:
+    (bits := bitarray()).frombytes(section)
+    bits = bits.to01()
+    symbols = (int(bits[i:i + 9], 2) for i in range(0, count * 9, 9))
+
+  (stream := bitarray()).frombytes(encoded[lzss_header.size + size:])
+  stream = stream.to01()
+
+  decoded = bytearray()
+  position = 0
+  for symbol in symbols:
+    if symbol < 256:
+      decoded.append(symbol)
+      continue
+    length = symbol - 256 + MIN_MATCH
+    distance = int(stream[position:position + window_bits], 2) + 1
+    position += window_bits
+    start = len(decoded) - distance
+    # Matches longer than their distance repeat the bytes they copy.
+    if distance >= length: decoded += decoded[start:start + length]
+    else: decoded += (decoded[start:] * (length // distance + 1))[:length]
+
+  return bytes(decoded)
+# endregion
+
 def verify():
   try:
     original = 'test text'
@@ -136,17 +496,75 @@ if __name__ == '__main__':
   for (size, subdir) in sizes:
     name = f'{subdir}_{filename}'
 
-    (encoded, code) = encode(original, size)
+    with mapped.mapfile(f"resources/{filename}") as view:
+      (encoded, code) = encode(view, size)
     save(name, encoded, code)
 
     (encoded, code) = load(name)
     decoding = create_decoding(code)
-    decoded = decode(encoded, decoding)
+    decoded = decode_array(encoded, decoding)
 
     assert original == decoded
+    save_container(name, encoded, code, len(original))
+    assert container.decode(f'results/{name}.container') == original
     print()
     print(f"Original text: {original[:100]}...")
     print(f"Decoded text : {decoded[:100]}...")
     print(f'Dictionary size: {size or "unlimited"} codes.')
     print(f'Size after compression: {format_size(len(encoded))}.')
     print(f"Compression ratio: {len(encoded) / (len(original) * 8) * 100:.2f}%.")
+
+  for (size, subdir) in sizes:
+    name = f'stream_{subdir}_{filename}'
+    max_bits = size and ceil(log2(size))
+
+    with open(f'results/{name}.encoded', 'wb') as file:
+      for chunk in encode_stream(mapped.mapchunks(f"resources/{filename}"), max_bits): file.write(chunk)
+
+    decoded = b''.join(decode_stream(readchunks(f'results/{name}.encoded')))
+    encoded_size = os.path.getsize(f'results/{name}.encoded') * 8
+
+    assert original == decoded
+    print()
+    print(f'Streaming dictionary size: {size or "unlimited"} codes.')
+    print(f'Size after compression: {format_size(encoded_size)}.')
+    print(f"Compression ratio: {encoded_size / (len(original) * 8) * 100:.2f}%.")
+
+  for processes in sorted({1, os.cpu_count()}):
+    start = time.perf_counter()
+    blocks = encode_blocks(original, block=2 ** 20, processes=processes)
+    encode_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    assert decode_blocks(blocks, processes=processes) == original
+    decode_elapsed = time.perf_counter() - start
+    encoded_size = sum(len(code) + len(payload) for (code, payload) in blocks) * 8
+    print()
+    print(f'Blocks coded by {processes} processes, unlimited dictionary.')
+    print(f'Size after compression: {format_size(encoded_size)}.')
+    print(f"Encoding: {len(original) / encode_elapsed / 2 ** 20:.2f} MiB/s, decoding: {len(original) / decode_elapsed / 2 ** 20:.2f} MiB/s.")
+
+  # Peak memory is taken in a second run under tracemalloc, which slows down
+  # every allocation.
+  def measured(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args, **kwargs)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+  for resource in sorted(os.listdir('resources')):
+    text = readfile(f'resources/{resource}')
+    print()
+    print(f'LZW and LZSS of {resource}.')
+    for (size, subdir) in sizes:
+      window = size or 2 ** ceil(log2(max(len(text), 2)))
+      ((table, payload), elapsed, peak) = measured(encode_block, text, size)
+      assert decode_container(table, payload) == text
+      print(f'LZW {subdir}: {format_size((len(table) + len(payload)) * 8)}, {len(text) / elapsed / 2 ** 20:.2f} MiB/s, peak {format_size(peak * 8)}.')
+      for huffman in (False, True):
+        (encoded, elapsed, peak) = measured(encode_lzss, text, window, huffman=huffman)
+        assert decode_lzss(encoded) == text
+        print(f"LZSS window {window}{' + Huffman' if huffman else ''}: {format_size(len(encoded) * 8)}, {len(text) / elapsed / 2 ** 20:.2f} MiB/s, peak {format_size(peak * 8)}.")
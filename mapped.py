@@ -0,0 +1,49 @@
+from codecs import getincrementaldecoder
+from collections import Counter
+from contextlib import contextmanager
+import mmap
+import os
+import re
+from typing import Iterable, Iterator
+
+from bitarray import bitarray
+
+# Files are memory-mapped so their pages are read when touched and are never
+# copied to the heap as a whole, this way files larger than memory get coded.
+@contextmanager
+def mapfile(filename: str) -> Iterator[memoryview]:
+  with open(filename, 'rb') as file:
+    if not os.fstat(file.fileno()).st_size:
+      yield memoryview(b'')
+      return
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+      yield view
+
+def mapchunks(filename: str, size: int = 2 ** 20) -> Iterable[memoryview]:
+  with mapfile(filename) as view:
+    for start in range(0, len(view), size):
+      with view[start:start + size] as chunk:
+        yield chunk
+
+# ASCII chunks are passed on untouched, iterating them gives code points instead
+# of letters, the others are decoded.
+non_ascii = re.compile(rb'[\x80-\xff]')
+def mapletters(filename: str, size: int = 2 ** 20) -> Iterable[memoryview | str]:
+  decoder = getincrementaldecoder('utf-8')()
+  for chunk in mapchunks(filename, size):
+    yield decoder.decode(chunk) if non_ascii.search(chunk) else chunk
+  if tail := decoder.decode(b'', final=True): yield tail
+
+def count_letters(chunks: Iterable[memoryview | str]) -> Counter:
+  counts = Counter()
+  for chunk in chunks: counts.update(chunk)
+  letters = Counter()
+  for (letter, count) in counts.items(): letters[chr(letter) if isinstance(letter, int) else letter] += count
+  return letters
+
+# Codes of ASCII letters are also keyed by their code points for the chunks
+# passed on untouched by `mapletters`.
+def create_mapped_codes(encoding: dict[str, str]) -> dict[str | int, bitarray]:
+  codes = {letter: bitarray(bits) for (letter, bits) in encoding.items()}
+  codes.update({ord(letter): bits for (letter, bits) in codes.items() if letter.isascii()})
+  return codes
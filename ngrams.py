@@ -0,0 +1,45 @@
+import math
+from typing import Sequence
+
+import numpy as np
+
+# N-grams of words or letters kept as ids into a sorted vocabulary, every
+# n-gram packed into a single integer with `bits` per id and the first id in
+# the highest bits. Counts stay in an array next to the sorted keys, so there
+# is no Python object per n-gram.
+def create_vocabulary(items: Sequence[str]) -> tuple[list[str], np.ndarray]:
+  vocabulary = sorted(set(items))
+  ids = {item: i for (i, item) in enumerate(vocabulary)}
+  return vocabulary, np.fromiter(map(ids.get, items), dtype=np.uint32, count=len(items))
+
+def count_bits(vocabulary: Sequence[str]) -> int:
+  return max(1, (len(vocabulary) - 1).bit_length())
+
+def pack_ngrams(ids: np.ndarray, degree: int, bits: int) -> tuple[np.ndarray, np.ndarray]:
+  degree = max(degree, 1)
+  if len(ids) < degree: return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+  if degree * bits <= 64:
+    keys = np.zeros(len(ids) - degree + 1, dtype=np.uint64)
+    for i in range(degree): keys = keys << np.uint64(bits) | ids[i:len(ids) - degree + 1 + i]
+    return np.unique(keys, return_counts=True)
+
+  # Wider keys do not fit in a machine word and are split into rows of 64 bit
+  # limbs, the highest first, so rows sort in the order of the keys.
+  width = -(-degree * bits // 64)
+  limbs = np.zeros((len(ids) - degree + 1, width), dtype=np.uint64)
+  for i in range(degree):
+    (limb, offset) = divmod(bits * (degree - 1 - i), 64)
+    column = ids[i:len(ids) - degree + 1 + i].astype(np.uint64)
+    limbs[:, width - 1 - limb] |= column << np.uint64(offset)
+    if offset + bits > 64: limbs[:, width - 2 - limb] |= column >> np.uint64(64 - offset)
+  return np.unique(limbs, axis=0, return_counts=True)
+
+def unpack_ngram(key: int | np.ndarray, degree: int, vocabulary: list[str]) -> tuple[str, ...]:
+  bits = count_bits(vocabulary)
+  if isinstance(key, np.ndarray): key = int.from_bytes(key.astype('>u8').tobytes(), 'big')
+  return tuple(vocabulary[key >> bits * i & (1 << bits) - 1] for i in range(max(degree, 1) - 1, -1, -1))
+
+def entropy(counts: np.ndarray, *, base: int = 2) -> float:
+  if not counts.sum(): return 0.0
+  probabilities = counts / counts.sum()
+  return float(-(probabilities * np.log(probabilities)).sum() / math.log(base))
@@ -0,0 +1,178 @@
+from collections import Counter
+from hashlib import blake2b
+import math
+from typing import Hashable, Iterable, Sequence
+
+import numpy as np
+
+# Approximate n-gram statistics in a fixed amount of memory, for texts which
+# are read in batches and whose exact counts do not fit:
+#
+#   count-min sketch  depth rows of width counters, an n-gram adds its count to
+#                     one counter of every row and its estimate is the smallest
+#                     of them, never below the true count and, with probability
+#                     1 - delta, above it by at most epsilon * total
+#   heavy hitters     k n-grams with the largest estimates seen so far
+#   HyperLogLog       2 ** precision registers with the longest run of leading
+#                     zeros of hashes, distinct count within 1.04 / sqrt(2 **
+#                     precision) relative standard error
+#
+# Every n-gram is hashed once into 64 bits shared by the rows and registers.
+def hash_items(items: Iterable[Hashable]) -> np.ndarray:
+  def digest(item) -> int:
+    key = item if isinstance(item, str) else ' '.join(item)
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'little')
+  return np.fromiter(map(digest, items), dtype=np.uint64)
+
+def bit_lengths(values: np.ndarray) -> np.ndarray:
+  # Halves of 32 bits are exact as floats, a whole 64 bit value is not.
+  (high, low) = ((values >> np.uint64(32)).astype(np.float64), (values & np.uint64(2 ** 32 - 1)).astype(np.float64))
+  return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+class CountMinSketch:
+  def __init__(self, epsilon: float = 1e-4, delta: float = 1e-3):
+    (self.epsilon, self.delta) = (epsilon, delta)
+    self.width = math.ceil(math.e / epsilon)
+    self.depth = math.ceil(math.log(1 / delta))
+    self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+    self.total = 0
+
+  def columns(self, hashes: np.ndarray) -> np.ndarray:
+    # Rows take hashes h1 + i * h2, as good as independent ones for the bound.
+    (first, second) = (hashes & np.uint64(2 ** 32 - 1), hashes >> np.uint64(32) | np.uint64(1))
+    rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+    return ((first + rows * second) % np.uint64(self.width)).astype(np.int64)
+
+  def add(self, hashes: np.ndarray, counts: np.ndarray):
+    columns = self.columns(hashes)
+    for (row, column) in zip(self.table, columns): np.add.at(row, column, counts)
+    self.total += int(counts.sum())
+
+  def estimate(self, hashes: np.ndarray) -> np.ndarray:
+    return self.table[np.arange(self.depth)[:, None], self.columns(hashes)].min(axis=0)
+
+  @property
+  def error(self) -> float:
+    return self.epsilon * self.total
+
+  def merge(self, other: 'CountMinSketch'):
+    self.table += other.table
+    self.total += other.total
+
+class HyperLogLog:
+  def __init__(self, precision: int = 14):
+    self.precision = precision
+    self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+  def add(self, hashes: np.ndarray):
+    rest = 64 - self.precision
+    ranks = rest - bit_lengths(hashes & np.uint64(2 ** rest - 1)) + 1
+    np.maximum.at(self.registers, (hashes >> np.uint64(rest)).astype(np.int64), ranks.astype(np.uint8))
+
+  def count(self) -> float:
+    m = len(self.registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+    # Small counts leave registers empty and are counted from those instead.
+    if estimate <= 2.5 * m and (zeros := int((self.registers == 0).sum())): return m * math.log(m / zeros)
+    return float(estimate)
+
+  @property
+  def error(self) -> float:
+    return 1.04 / math.sqrt(len(self.registers))
+
+  def merge(self, other: 'HyperLogLog'):
+    np.maximum(self.registers, other.registers, out=self.registers)
+
+class NgramSketch:
+  def __init__(self, *, epsilon: float = 1e-4, delta: float = 1e-3, precision: int = 14, k: int = 1000):
+    self.counts = CountMinSketch(epsilon, delta)
+    self.distinct = HyperLogLog(precision)
+    self.k = k
+    self.heavy: dict[Hashable, int] = {}
+
+  def update(self, ngrams: Counter):
+    if not ngrams: return
+    items = list(ngrams)
+    hashes = hash_items(items)
+    self.counts.add(hashes, np.fromiter(ngrams.values(), dtype=np.int64, count=len(items)))
+    self.distinct.add(hashes)
+
+    # Only n-grams which may get into the k largest are looked at, estimates
+    # of the other kept ones stay valid as they never fall.
+    estimates = self.counts.estimate(hashes)
+    threshold = min(self.heavy.values()) if len(self.heavy) >= self.k else 0
+    for i in np.flatnonzero(estimates > threshold).tolist(): self.heavy[items[i]] = int(estimates[i])
+    if len(self.heavy) > self.k:
+      self.heavy = dict(sorted(self.heavy.items(), key=lambda item: item[1], reverse=True)[:self.k])
+
+  def merge(self, other: 'NgramSketch'):
+    self.counts.merge(other.counts)
+    self.distinct.merge(other.distinct)
+    items = list(self.heavy.keys() | other.heavy.keys())
+    estimates = self.counts.estimate(hash_items(items)).tolist()
+    self.heavy = dict(sorted(zip(items, estimates), key=lambda item: item[1], reverse=True)[:self.k])
+
+  @property
+  def total(self) -> int:
+    return self.counts.total
+
+  @property
+  def nbytes(self) -> int:
+    return self.counts.table.nbytes + self.distinct.registers.nbytes
+
+  def most_common(self, n: int = None) -> list[tuple[Hashable, int]]:
+    # Counts are over the true ones by at most `error`.
+    return sorted(self.heavy.items(), key=lambda item: item[1], reverse=True)[:n]
+
+  def count_distinct(self) -> tuple[float, float]:
+    return self.distinct.count(), self.distinct.error
+
+  @property
+  def error(self) -> float:
+    return self.counts.error
+
+  def entropy(self, *, base: int = 2) -> tuple[float, float, float]:
+    # Heavy hitters are taken with their estimated counts. The rest of the
+    # mass is at most as concentrated as the smallest of them and at most as
+    # spread as over all the other distinct n-grams, the latter within three
+    # standard errors, which gives the lower and the upper bound, the estimate
+    # spreads it over the estimated number of them.
+    if not self.total: return 0.0, 0.0, 0.0
+    probabilities = np.array(list(self.heavy.values()), dtype=np.float64) / self.total
+    heavy = float(-(probabilities * np.log(probabilities)).sum())
+    rest = max(1 - float(probabilities.sum()), 0)
+    if not rest: return (heavy / math.log(base),) * 3
+
+    (distinct, error) = self.count_distinct()
+    largest = min(float(probabilities.min()) if len(probabilities) else rest, rest)
+    low = heavy + rest * math.log(1 / largest)
+    high = heavy + rest * math.log(max(distinct * (1 + 3 * error) - len(self.heavy), 1) / rest)
+    estimate = min(max(heavy + rest * math.log(max(distinct - len(self.heavy), 1) / rest), low), high)
+    return estimate / math.log(base), low / math.log(base), high / math.log(base)
+
+def count(batches: Iterable[Sequence], *orders: int, **options) -> list[NgramSketch]:
+  # Batches are strings of letters or lists of words, n-grams over the border
+  # of two batches are counted from the last symbols of the first one. Order 0
+  # counts the symbols themselves, other ones their strings or tuples.
+  sketches = [NgramSketch(**options) for _ in orders]
+  longest = max(orders, default=0)
+  tail = None
+  for batch in batches:
+    symbols = batch if tail is None else tail + batch
+    for (n, sketch) in zip(orders, sketches):
+      start = len(symbols) - len(batch) if tail is not None else 0
+      if n == 0:
+        sketch.update(Counter(batch))
+      elif isinstance(symbols, str):
+        sketch.update(Counter(symbols[i:i + n] for i in range(max(start - n + 1, 0), len(symbols) - n + 1)))
+      else:
+        sketch.update(Counter(tuple(symbols[i:i + n]) for i in range(max(start - n + 1, 0), len(symbols) - n + 1)))
+    tail = symbols[max(len(symbols) - longest + 1, 0):] if longest > 1 else symbols[:0]
+  return sketches
+
+def conditional_entropy(sketches: Sequence[NgramSketch], *, base: int = 2) -> tuple[float, float, float]:
+  # Conditional entropy of the last symbol of n-grams is the difference of
+  # the entropies of n-grams and of their prefixes, which sets its bounds.
+  if len(sketches) == 1: return sketches[0].entropy(base=base)
+  ((estimate, low, high), (prefix, prefix_low, prefix_high)) = (sketches[1].entropy(base=base), sketches[0].entropy(base=base))
+  return estimate - prefix, max(low - prefix_high, 0), high - prefix_low